@@ -0,0 +1,177 @@
+"""Time each stage of a pdref run on a synthetic corpus and print JSON.
+
+    python bench.py --docs 10 --pages 50 --output results.json
+
+Each stage is run --repeat times on fresh output folders; the JSON has
+the minimum and median of each, plus the corpus settings and environment,
+so results from different commits can be compared. The import time of
+the GUI and CLI modules is included too (see startup.py).
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "pdref"))
+
+import fitz
+from startup import check_startup
+from synthetic import add_corpus_arguments, corpus_settings, make_corpus
+from crawl import crawl, find_pdfs
+from images import ImageStore
+from parse import WordIndex, WordTable, write_index, write_notes
+from userpreferences import UserPreferences
+
+HIGHLIGHT_TYPES = (8, 9, 10, 11)
+
+
+class Timer:
+    def __init__(self):
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def time(self, stage, fn, *args, **kwargs):
+        start = perf_counter()
+        result = fn(*args, **kwargs)
+        self.add(stage, perf_counter() - start)
+        return result
+
+
+def run_stages(corpus, work, preferences):
+    'Run the stages of process_pdf one by one over the corpus; returns (seconds, counts)'
+    timer = Timer()
+    counts = {"pdfs": 0, "pages": 0, "annotated_pages": 0, "annotations": 0, "highlights": 0, "words": 0, "images": 0}
+
+    pdfs = timer.time("walk", lambda: list(find_pdfs(corpus)))
+    counts["pdfs"] = len(pdfs)
+
+    for path_to_pdf, slug in pdfs:
+        path_to_notes = os.path.join(work, slug)
+        os.makedirs(path_to_notes, exist_ok=True)
+        path_to_pdf_copy = os.path.join(path_to_notes, f"{slug}.pdf")
+        timer.time("copy", shutil.copy, path_to_pdf, path_to_pdf_copy)
+
+        doc = timer.time("open", fitz.open, path_to_pdf)
+        counts["pages"] += doc.page_count
+        counts["images"] += sum(len(doc.get_page_images(i)) for i in range(doc.page_count))
+
+        image_store = ImageStore(work) if preferences.dedupe_images else None
+        timer.time("images", write_index, doc, os.path.join(path_to_notes, "_index.md"), path_to_pdf_copy,
+                   path_to_notes, image_store = image_store, image_threads = preferences.image_threads)
+
+        for page in doc:
+            annots = list(page.annots())
+            if not annots:
+                continue
+            counts["annotated_pages"] += 1
+            counts["annotations"] += len(annots)
+            highlights = [a for a in annots if a.type[0] in HIGHLIGHT_TYPES]
+            if not highlights:
+                continue
+            counts["highlights"] += len(highlights)
+            table = timer.time("words", WordTable.from_page, page)
+            counts["words"] += len(table)
+
+            def match():
+                index = WordIndex(table)
+                return [table.make_text(index.intersecting(a.rect)) for a in highlights]
+            timer.time("matching", match)
+
+        stats = {"pages_skipped": 0, "images_filtered": {}}
+        timer.time("notes", write_notes, doc, path_to_notes, path_to_pdf_copy, "benchmark", stats)
+        doc.close()
+
+    return timer.seconds, counts
+
+
+def run_crawl(corpus, work, preferences):
+    preferences.pdfs_path = corpus
+    preferences.notes_path = work
+    start = perf_counter()
+    with redirect_stdout(open(os.devnull, "w")):
+        crawl(preferences)
+    return perf_counter() - start
+
+
+def summarize(samples):
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "runs": samples,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_corpus_arguments(parser)
+    parser.add_argument("--corpus", help="use this folder of PDFs instead of generating one")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage (default 3)")
+    parser.add_argument("--workers", type=int, default=1, help="workers for the end-to-end crawl (default 1)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    settings = corpus_settings(args)
+    with tempfile.TemporaryDirectory(prefix="pdref-bench-") as tmp:
+        corpus = args.corpus
+        if not corpus:
+            corpus = os.path.join(tmp, "corpus")
+            make_corpus(corpus, **settings)
+
+        stage_samples = {}
+        crawl_samples = []
+        counts = {}
+        for run in range(args.repeat):
+            preferences = UserPreferences(workers = args.workers, incremental = False)
+            work = os.path.join(tmp, f"stages-{run}")
+            os.makedirs(work)
+            with redirect_stdout(open(os.devnull, "w")):
+                seconds, counts = run_stages(corpus, work, preferences)
+            for stage, value in seconds.items():
+                stage_samples.setdefault(stage, []).append(value)
+            crawl_samples.append(run_crawl(corpus, os.path.join(tmp, f"crawl-{run}"), preferences))
+
+    result = {
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "pymupdf": fitz.VersionBind,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "corpus": {"path": args.corpus} if args.corpus else settings,
+        "counts": counts,
+        "repeat": args.repeat,
+        "stages": {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        "crawl": dict(summarize(crawl_samples), workers=args.workers),
+        "startup": check_startup(repeat=args.repeat),
+    }
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
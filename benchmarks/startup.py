@@ -0,0 +1,66 @@
+"""Check that the GUI and CLI modules start without loading PyMuPDF.
+
+    python startup.py            # exits with 1 on a regression
+
+Each module is imported in a fresh interpreter, timed, and checked for
+heavy modules that should only load once a run starts.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PDREF = os.path.join(HERE, "..", "pdref")
+
+SURFACES = ("gui", "cli")
+HEAVY_MODULES = ("fitz", "pymupdf", "sqlite3", "parse", "crawl")
+
+PROBE = """
+import sys, time
+sys.path.insert(0, {pdref!r})
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(repr((seconds, [m for m in {heavy!r} if m in sys.modules])))
+"""
+
+
+def measure_startup(module, repeat = 3):
+    'Return (best import time in seconds, heavy modules loaded) for a fresh interpreter'
+    best, loaded = None, []
+    for _ in range(repeat):
+        code = PROBE.format(pdref=os.path.abspath(PDREF), module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        seconds, loaded = eval(output.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best, loaded
+
+
+def check_startup(max_seconds = None, repeat = 3):
+    results = {}
+    for module in SURFACES:
+        seconds, loaded = measure_startup(module, repeat)
+        results[module] = {
+            "seconds": seconds,
+            "heavy_modules": loaded,
+            "ok": not loaded and (max_seconds is None or seconds <= max_seconds),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-seconds", type=float, help="also fail if an import takes longer than this")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = check_startup(args.max_seconds, args.repeat)
+    print(json.dumps(results, indent=2))
+    if not all(r["ok"] for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
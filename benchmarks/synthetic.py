@@ -0,0 +1,175 @@
+"""Generate synthetic PDFs for benchmarking pdref.
+
+Everything is made locally with PyMuPDF from a seed, so the same
+settings always give the same corpus.
+"""
+import argparse
+import os
+import random
+import fitz
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+         "exercitation ullamco laboris nisi aliquip ex ea commodo consequat").split()
+
+ANNOT_TYPES = ("text", "freetext", "highlight", "underline")
+IMAGE_KINDS = ("rgb", "gray", "cmyk", "jpeg", "shared")
+
+FONT_SIZE = 10
+LINE_HEIGHT = 12
+MARGIN = 50
+
+
+def make_pixmap(kind, size, rng):
+    if kind == "gray":
+        pix = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, size, size), False)
+        pix.set_rect(pix.irect, (rng.randrange(256),))
+    elif kind == "cmyk":
+        pix = fitz.Pixmap(fitz.csCMYK, fitz.IRect(0, 0, size, size), False)
+        pix.set_rect(pix.irect, tuple(rng.randrange(256) for _ in range(4)))
+    else:
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, size, size), False)
+        pix.set_rect(pix.irect, tuple(rng.randrange(256) for _ in range(3)))
+    # A second block so the image doesn't compress to nothing
+    pix.set_rect(fitz.IRect(0, 0, size // 2, size // 3), tuple(rng.randrange(256) for _ in range(pix.n)))
+    return pix
+
+
+def write_text(page, words_per_page, rng):
+    'Fill the page with lines of words; returns the rect of each line'
+    width = page.rect.width - 2 * MARGIN
+    per_line = max(int(width / (FONT_SIZE * 3.2)), 1)
+    line_rects = []
+    y = MARGIN + FONT_SIZE
+    remaining = words_per_page
+    while remaining > 0 and y < page.rect.height - MARGIN:
+        count = min(per_line, remaining)
+        line = " ".join(rng.choice(WORDS) for _ in range(count))
+        page.insert_text((MARGIN, y), line, fontsize=FONT_SIZE)
+        length = fitz.get_text_length(line, fontsize=FONT_SIZE)
+        line_rects.append(fitz.Rect(MARGIN, y - FONT_SIZE, MARGIN + length, y + 2))
+        remaining -= count
+        y += LINE_HEIGHT
+    return line_rects
+
+
+def add_annotations(page, line_rects, annots, rng):
+    for kind in ANNOT_TYPES:
+        for n in range(annots.get(kind, 0)):
+            if kind == "text":
+                annot = page.add_text_annot((page.rect.width - MARGIN / 2, MARGIN + 20 * n), f"comment {n}")
+            elif kind == "freetext":
+                annot = page.add_freetext_annot(fitz.Rect(MARGIN, 5, MARGIN + 150, 5 + FONT_SIZE + 4), f"free text {n}", fontsize=8)
+            else:
+                if not line_rects:
+                    continue
+                first = rng.randrange(len(line_rects))
+                rects = line_rects[first:first + rng.randint(1, 3)]
+                quads = [r.quad for r in rects]
+                if kind == "highlight":
+                    annot = page.add_highlight_annot(quads=quads)
+                else:
+                    annot = page.add_underline_annot(quads=quads)
+                if rng.random() < 0.5:
+                    annot.set_info(content=f"{kind} note {n}")
+            annot.update()
+
+
+def add_images(doc, page, images, shared, rng):
+    slot = 0
+    for kind in IMAGE_KINDS:
+        for n in range(images.get(kind, 0)):
+            x = MARGIN + (slot % 4) * 120
+            y = page.rect.height - MARGIN - 110 - (slot // 4) * 110
+            rect = fitz.Rect(x, y, x + 100, y + 100)
+            slot += 1
+            if kind == "shared":
+                key = ("shared", n)
+                if key in shared:
+                    page.insert_image(rect, xref=shared[key])
+                else:
+                    shared[key] = page.insert_image(rect, pixmap=make_pixmap("rgb", 64, random.Random(n)))
+            elif kind == "jpeg":
+                page.insert_image(rect, stream=make_pixmap("rgb", 96, rng).tobytes("jpeg"))
+            else:
+                page.insert_image(rect, pixmap=make_pixmap(kind, 64, rng))
+
+
+def make_pdf(path, pages = 10, words_per_page = 300, annots = None, images = None, annotated_every = 1, seed = 0):
+    """Write one synthetic PDF.
+    annots and images give counts per page, e.g. {"highlight": 2, "text": 1}
+    and {"rgb": 1, "shared": 1}. Only every annotated_every-th page gets
+    annotations.
+    """
+    rng = random.Random(seed)
+    annots = annots or {}
+    images = images or {}
+    doc = fitz.open()
+    doc.set_metadata({"title": f"Synthetic {seed}", "author": "pdref benchmark", "keywords": "benchmark,synthetic"})
+    shared = {}
+    for number in range(pages):
+        page = doc.new_page()
+        line_rects = write_text(page, words_per_page, rng)
+        if number % annotated_every == 0:
+            add_annotations(page, line_rects, annots, rng)
+        add_images(doc, page, images, shared, rng)
+    doc.save(path, garbage=1, deflate=True)
+    doc.close()
+
+
+def make_corpus(root, docs = 5, subfolders = 2, **kwargs):
+    'Write docs PDFs spread over nested subfolders; returns their paths'
+    paths = []
+    for n in range(docs):
+        folder = os.path.join(root, *[f"folder-{n % (level + 2)}" for level in range(subfolders)])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"Synthetic Document {n:04d}.pdf")
+        make_pdf(path, seed=n, **kwargs)
+        paths.append(path)
+    return paths
+
+
+def parse_counts(text, allowed):
+    'Parse "highlight=2,text=1" into a dict'
+    counts = {}
+    for item in filter(None, (text or "").split(",")):
+        key, _, value = item.partition("=")
+        if key not in allowed:
+            raise argparse.ArgumentTypeError(f"unknown kind {key!r}; choose from {', '.join(allowed)}")
+        counts[key] = int(value or 1)
+    return counts
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument("--docs", type=int, default=5, help="number of PDFs (default 5)")
+    parser.add_argument("--pages", type=int, default=20, help="pages per PDF (default 20)")
+    parser.add_argument("--words", type=int, default=300, help="words per page (default 300)")
+    parser.add_argument("--annots", default="text=1,freetext=0,highlight=2,underline=1",
+                        help=f"annotations per page by type ({', '.join(ANNOT_TYPES)})")
+    parser.add_argument("--annotated-every", type=int, default=1, help="only every Nth page is annotated (default 1)")
+    parser.add_argument("--images", default="rgb=1,gray=0,cmyk=0,jpeg=0,shared=1",
+                        help=f"images per page by kind ({', '.join(IMAGE_KINDS)})")
+
+
+def corpus_settings(args):
+    return {
+        "docs": args.docs,
+        "pages": args.pages,
+        "words_per_page": args.words,
+        "annots": parse_counts(args.annots, ANNOT_TYPES),
+        "images": parse_counts(args.images, IMAGE_KINDS),
+        "annotated_every": args.annotated_every,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="folder to write the PDFs to")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    paths = make_corpus(args.output, **corpus_settings(args))
+    print(f"Wrote {len(paths)} PDFs to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
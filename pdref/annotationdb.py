@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+
+DB_NAME = "pdref.sqlite"
+
+ANNOT_TYPE_NAMES = {0: "Text", 2: "FreeText", 8: "Highlight", 9: "Underline", 10: "Squiggly", 11: "StrikeOut"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    id TEXT PRIMARY KEY,
+    slug TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    type_name TEXT NOT NULL,
+    x0 REAL, y0 REAL, x1 REAL, y1 REAL,
+    comment TEXT NOT NULL DEFAULT '',
+    quote TEXT NOT NULL DEFAULT '',
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_slug ON annotations(slug);
+CREATE TABLE IF NOT EXISTS pdfs (
+    slug TEXT PRIMARY KEY,
+    updated TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS annotations_fts USING fts5(
+    slug, comment, quote, content='annotations', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS annotations_ai AFTER INSERT ON annotations BEGIN
+    INSERT INTO annotations_fts(rowid, slug, comment, quote) VALUES (new.rowid, new.slug, new.comment, new.quote);
+END;
+CREATE TRIGGER IF NOT EXISTS annotations_ad AFTER DELETE ON annotations BEGIN
+    INSERT INTO annotations_fts(annotations_fts, rowid, slug, comment, quote) VALUES ('delete', old.rowid, old.slug, old.comment, old.quote);
+END;
+CREATE TRIGGER IF NOT EXISTS annotations_au AFTER UPDATE ON annotations BEGIN
+    INSERT INTO annotations_fts(annotations_fts, rowid, slug, comment, quote) VALUES ('delete', old.rowid, old.slug, old.comment, old.quote);
+    INSERT INTO annotations_fts(rowid, slug, comment, quote) VALUES (new.rowid, new.slug, new.comment, new.quote);
+END;
+"""
+
+
+def annotation_id(slug, page, annot):
+    """The id stays the same across runs: it uses the page and the annotation's
+    own name (/NM) when the PDF has one, otherwise its type and position.
+    """
+    name = annot.info.get('id', '')
+    rect = tuple(round(v, 1) for v in annot.rect)
+    identity = repr((slug, page, name) if name else (slug, page, annot.type[0], rect))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def annotation_row(slug, page, annot, quote = ''):
+    "Return the row stored for one annotation"
+    annot_type = annot.type[0]
+    rect = tuple(round(v, 1) for v in annot.rect)
+    return {
+        "id": annotation_id(slug, page, annot),
+        "slug": slug,
+        "page": page,
+        "type": annot_type,
+        "type_name": ANNOT_TYPE_NAMES.get(annot_type, annot.type[1]),
+        "x0": rect[0], "y0": rect[1], "x1": rect[2], "y1": rect[3],
+        "comment": annot.info['content'],
+        "quote": quote,
+    }
+
+
+class AnnotationDB:
+    '''SQLite store of every extracted annotation, full-text indexed with FTS5.
+
+    Sits next to the Markdown notes as <notes>/pdref.sqlite. Rows are upserted
+    by a stable annotation id, so reruns update rows in place instead of
+    adding duplicates, and annotations removed from a PDF are deleted.
+    The pdfs table lists every PDF stored, including those without
+    annotations.
+    '''
+
+    def __init__(self, notes_path):
+        self.path = os.path.join(notes_path, DB_NAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        self.pdfs = self.slugs()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def replace_pdf(self, slug, rows):
+        'Make the stored annotations for slug match rows'
+        with self.connection:
+            # Staged in a temporary table: one parameter per id would go over
+            # SQLite's variable limit for a heavily annotated PDF
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept (id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM kept")
+            self.connection.executemany("INSERT OR IGNORE INTO kept (id) VALUES (?)", [(row["id"],) for row in rows])
+            self.connection.execute(
+                "DELETE FROM annotations WHERE slug = ? AND id NOT IN (SELECT id FROM kept)",
+                (slug,)
+            )
+            self.upsert(rows)
+            self.stored(slug)
+
+    def update_pdf(self, slug, rows, removed_ids):
+        'Apply a delta: upsert rows and delete removed_ids, leaving other annotations alone'
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM annotations WHERE slug = ? AND id = ?",
+                [(slug, id) for id in removed_ids]
+            )
+            self.upsert(rows)
+            self.stored(slug)
+
+    def stored(self, slug):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pdfs (slug, updated) VALUES (?, ?)",
+            (slug, datetime.now().isoformat(timespec='seconds'))
+        )
+        self.pdfs.add(slug)
+
+    def has_pdf(self, slug):
+        return slug in self.pdfs
+
+    def slugs(self):
+        'Return the set of slugs stored, including any from before the pdfs table was kept'
+        return {row[0] for row in self.connection.execute(
+            "SELECT slug FROM pdfs UNION SELECT DISTINCT slug FROM annotations"
+        )}
+
+    def upsert(self, rows):
+        updated = datetime.now().isoformat(timespec='seconds')
+        self.connection.executemany(
+            """INSERT INTO annotations (id, slug, page, type, type_name, x0, y0, x1, y1, comment, quote, updated)
+            VALUES (:id, :slug, :page, :type, :type_name, :x0, :y0, :x1, :y1, :comment, :quote, :updated)
+            ON CONFLICT(id) DO UPDATE SET
+                page = excluded.page, type = excluded.type, type_name = excluded.type_name,
+                x0 = excluded.x0, y0 = excluded.y0, x1 = excluded.x1, y1 = excluded.y1,
+                comment = excluded.comment, quote = excluded.quote, updated = excluded.updated
+            WHERE comment IS NOT excluded.comment OR quote IS NOT excluded.quote
+                OR page IS NOT excluded.page OR type IS NOT excluded.type
+                OR x0 IS NOT excluded.x0 OR y0 IS NOT excluded.y0
+                OR x1 IS NOT excluded.x1 OR y1 IS NOT excluded.y1""",
+            [dict(row, updated=updated) for row in rows]
+        )
+
+    def search(self, query, limit = 50):
+        'Return (slug, page, type_name, comment, quote) for the best matches of an FTS5 query'
+        return self.connection.execute(
+            """SELECT a.slug, a.page, a.type_name, a.comment, a.quote
+            FROM annotations_fts JOIN annotations a ON a.rowid = annotations_fts.rowid
+            WHERE annotations_fts MATCH ? ORDER BY rank LIMIT ?""",
+            (query, limit)
+        ).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the annotations pdref has extracted")
+    parser.add_argument("notes_path", help="the notes folder pdref writes to")
+    parser.add_argument("query", help="FTS5 query, e.g. 'entropy' or 'quote: \"free energy\"'")
+    parser.add_argument("-n", "--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.notes_path, DB_NAME)):
+        print(f"No {DB_NAME} in {args.notes_path}; run pdref with the annotation database enabled first")
+        return
+
+    with AnnotationDB(args.notes_path) as db:
+        for slug, page, type_name, comment, quote in db.search(args.query, args.limit):
+            print(f"{slug} p.{page} [{type_name}]")
+            if comment:
+                print(f"    {comment}")
+            if quote:
+                print(f"    > {quote}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import json
+import os
+from datetime import datetime
+import text_utils
+from images import write_file
+
+CATALOG_NAME = "catalog"
+INDEX_NAME = "catalog-index"
+CATALOG_VERSION = 1
+
+
+def catalog_info(doc, slugified_title, annotations):
+    'What the catalog shows for an open PDF with the given number of annotations'
+    metadata = doc.metadata
+    return {
+        "title": metadata['title'] or slugified_title,
+        "author": metadata['author'],
+        "keywords": [key.strip() for key in metadata['keywords'].split(',') if key.strip()],
+        "pages": doc.page_count,
+        "annotations": annotations,
+    }
+
+
+def cell(text):
+    # Keep table cells on one line and their pipes out of the table syntax
+    return str(text).replace("|", "\\|").replace("\n", " ")
+
+
+class Catalog:
+    '''Library-wide list of every processed PDF, in the notes folder.
+
+    catalog.json holds one entry per notes folder (title, author, keywords,
+    pages and number of annotations, from catalog_info) plus keyword and
+    author indexes; catalog.md and catalog-index.md show the same as
+    Markdown, linking to each PDF's _index.md. Entries are updated one at a
+    time as PDFs are processed, and the files are only rewritten when an
+    entry changed.
+    '''
+
+    def __init__(self, notes_path):
+        self.notes_path = notes_path
+        self.path = os.path.join(notes_path, f"{CATALOG_NAME}.json")
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            print("The catalog could not be read; it will be rebuilt as PDFs are processed")
+            return
+        if data.get("version") == CATALOG_VERSION:
+            self.entries = data.get("pdfs", {})
+
+    def has(self, slugified_title):
+        return slugified_title in self.entries
+
+    def update(self, path_to_pdf, entry):
+        'Update the catalog from a manifest entry; entries without catalog info are ignored'
+        if not entry or not entry.get("catalog"):
+            return
+        slug = entry["slug"]
+        new = dict(entry["catalog"], pdf = path_to_pdf)
+        old = self.entries.get(slug)
+        if old is not None and {k: v for k, v in old.items() if k != "updated"} == new:
+            return
+        new["updated"] = datetime.now().strftime("%Y-%m-%d")
+        self.entries[slug] = new
+        self.changed = True
+
+    def indexes(self):
+        'Return ({keyword: [slugs]}, {author: [slugs]}), each sorted'
+        keywords, authors = {}, {}
+        for slug, entry in self.entries.items():
+            for key in entry["keywords"]:
+                keywords.setdefault(key, []).append(slug)
+            if entry["author"]:
+                authors.setdefault(entry["author"], []).append(slug)
+        for index in (keywords, authors):
+            for slugs in index.values():
+                slugs.sort()
+        return dict(sorted(keywords.items(), key=lambda i: i[0].casefold())), dict(sorted(authors.items(), key=lambda i: i[0].casefold()))
+
+    def save(self):
+        'Write the catalog files if any entry changed; returns whether they were written'
+        if not self.changed:
+            return False
+        keywords, authors = self.indexes()
+        slugs = sorted(self.entries, key=lambda slug: self.entries[slug]["title"].casefold())
+        links = {slug: f"[{cell(entry['title'])}]({slug}/_index.md)" for slug, entry in self.entries.items()}
+
+        # Compact, so the C encoder is used; pretty-printing takes seconds for a large library
+        data = json.dumps({"version": CATALOG_VERSION, "pdfs": self.entries, "keywords": keywords, "authors": authors}, separators=(',', ':'), sort_keys=True)
+        write_file(self.path, data.encode('utf-8'))
+
+        lines = text_utils.make_frontmatter(title = "Catalog", top_level = "true")
+        lines += ["\n\n", "| Title | Author | Keywords | Pages | Annotations |\n", "| --- | --- | --- | --- | --- |\n"]
+        for slug in slugs:
+            entry = self.entries[slug]
+            lines.append(f"| {links[slug]} | {cell(entry['author'])} | {cell(', '.join(entry['keywords']))} | {entry['pages']} | {entry['annotations']} |\n")
+        write_file(os.path.join(self.notes_path, f"{CATALOG_NAME}.md"), "".join(lines).encode('utf-8'))
+
+        lines = text_utils.make_frontmatter(title = "Keywords and authors", top_level = "true")
+        for heading, index in (("Keywords", keywords), ("Authors", authors)):
+            lines += ["\n\n", f"## {heading}\n"]
+            for name, listed in index.items():
+                lines.append(f"\n### {name}\n\n")
+                lines += [f"- {links[slug]}\n" for slug in listed]
+        write_file(os.path.join(self.notes_path, f"{INDEX_NAME}.md"), "".join(lines).encode('utf-8'))
+
+        self.changed = False
+        return True
@@ -0,0 +1,109 @@
+import argparse
+import json
+import multiprocessing
+from userpreferences import UserPreferences
+
+
+def load_config(path, preferences):
+    # A config file is a JSON object of UserPreferences attributes
+    with open(path, "r", encoding='utf-8') as f:
+        config = json.load(f)
+    for key, value in config.items():
+        if hasattr(preferences, key):
+            setattr(preferences, key, value)
+        else:
+            print(f"Ignoring unknown setting in {path}: {key}")
+
+
+def build_preferences(args):
+    preferences = UserPreferences()
+    if args.config:
+        load_config(args.config, preferences)
+
+    # Command line arguments win over the config file
+    overrides = {
+        "pdfs_path": args.refs,
+        "notes_path": args.notes,
+        "earliest_modified_date": args.since,
+        "workers": args.workers,
+        "image_size": args.image_min_area,
+        "image_margin": args.image_margin,
+        "memory_limit_mb": args.memory_limit,
+        "include": args.include,
+        "exclude": args.exclude,
+        "max_depth": args.max_depth,
+    }
+    for key, value in overrides.items():
+        if value is not None:
+            setattr(preferences, key, value)
+    if args.full:
+        preferences.incremental = False
+    if args.resume:
+        preferences.resume = True
+    if args.snapshots:
+        preferences.annotation_snapshots = True
+    if args.catalog:
+        preferences.catalog = True
+    if args.annotation_db:
+        preferences.annotation_db = True
+    if args.delta:
+        preferences.delta_notes = True
+    if args.stream:
+        preferences.stream_discovery = True
+    if args.debug:
+        preferences.debug = True
+    return preferences
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="pdref", description="Extract notes, highlights and images from a folder of PDFs")
+    parser.add_argument("--refs", help="folder to look for PDFs in (searched recursively)")
+    parser.add_argument("--notes", help="output folder for notes")
+    parser.add_argument("--config", help="JSON file of preferences, e.g. {\"pdfs_path\": ..., \"workers\": 4}")
+    parser.add_argument("--since", help="only PDFs modified after this date (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, help="number of processes to use")
+    parser.add_argument("--include", action="append", metavar="GLOB", help="only files matching this pattern (default *.pdf); can be repeated")
+    parser.add_argument("--exclude", action="append", metavar="GLOB", help="leave out files and folders matching this pattern; can be repeated")
+    parser.add_argument("--max-depth", type=int, help="how many folders deep to search (0 for the refs folder only)")
+    parser.add_argument("--stream", action="store_true", help="start processing PDFs while the refs folder is still being searched")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run, skipping the PDFs it already finished")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and reprocess every PDF")
+    parser.add_argument("--delta", action="store_true", help="only write annotations added, changed or removed since the last notes file")
+    parser.add_argument("--snapshots", action="store_true", help="include pictures of ink and shape annotations in the notes")
+    parser.add_argument("--catalog", action="store_true", help="keep a catalog of every PDF, with keyword and author indexes, in the notes folder")
+    parser.add_argument("--annotation-db", action="store_true", help="also keep annotations in pdref.sqlite")
+    parser.add_argument("--image-min-area", type=int, help="skip images with fewer pixels than this")
+    parser.add_argument("--image-margin", type=float, help="skip images drawn entirely within this many points of the page edge")
+    parser.add_argument("--memory-limit", type=int, help="memory ceiling per process in MB; larger PDFs use a slower low-memory mode")
+    parser.add_argument("--debug", action="store_true", help="add image details to _index.md")
+
+    parser.add_argument("--watch", action="store_true", help="keep running and process PDFs as they are added or modified")
+    parser.add_argument("--debounce", type=float, default=2.0, help="seconds without changes before a batch is processed (default 2)")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="seconds between scans when inotify isn't available (default 5)")
+    parser.add_argument("--polling", action="store_true", help="scan for changes instead of using inotify")
+    return parser
+
+
+def main(argv = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    preferences = build_preferences(args)
+
+    if not preferences.pdfs_path or not preferences.notes_path:
+        parser.error("a refs folder and a notes folder are required (--refs/--notes or --config)")
+
+    if args.watch:
+        from watch import watch
+        try:
+            watch(preferences, debounce = args.debounce, poll_interval = args.poll_interval, polling = args.polling)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+    else:
+        from crawl import crawl
+        crawl(preferences)
+
+
+if __name__ == '__main__':
+    # Needed for process pools in the frozen (pyinstaller) build
+    multiprocessing.freeze_support()
+    main()
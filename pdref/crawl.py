@@ -1,10 +1,73 @@
+import io
+from collections import Counter, deque
 import os
-import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
+import fitz
 import text_utils
-from parse import process_pdf
+from annotationdb import AnnotationDB
+from catalog import Catalog, catalog_info
+from delta import AnnotationRecord
+from images import ImageFilter, ImageStore
+from journal import Journal
+from ingest import DuplicateFinder, Source, place_copy
+from manifest import Manifest
+from memory import MemoryGuard
+from parse import process_pdf, annotation_digest, collect_annotation_rows
+from pipeline import PendingPdf, WriteBehind, prefetch_sources, threaded
+from runreport import PdfReport, maybe_profile, write_run_report
+from snapshots import Snapshots
+from walk import PdfWalker
+from wordcache import WordCache
 
-def prepare_pdf(path_to_pdf, slugified_title, preferences):
+# PDFs a pipelined serial run reads ahead of, and lets write behind, the
+# one being extracted
+PIPELINE_DEPTH = 2
+
+class ShardLater(Exception):
+    'Raised in a pool worker for a PDF big enough to be split into page ranges'
+
+def copy_pdf(source, path_to_pdf_copy, mode, report):
+    with report.stage("copy"):
+        method = place_copy(source, path_to_pdf_copy, mode)
+    report.count(f"copy_{method}")
+    if method == "copy":
+        report.count("bytes_copied", os.path.getsize(path_to_pdf_copy))
+
+def backfill_stats(doc, slugified_title, preferences, path_to_notes, report):
+    # The notes are up to date but the annotation database has nothing for
+    # this PDF yet: its rows are collected without writing notes
+    word_cache = WordCache(preferences.notes_path, preferences.word_cache_mb) if preferences.word_cache_mb else None
+    snapshots = None
+    if preferences.annotation_snapshots:
+        snapshots = Snapshots(path_to_notes, preferences.snapshot_dpi, preferences.snapshot_max_pixels)
+    with report.stage("backfill"):
+        rows = collect_annotation_rows(doc, slugified_title, word_cache, report, snapshots)
+    print("    Added to the annotation database")
+    return {"annotations": rows, "images_filtered": Counter()}
+
+def prepare_pdf(path_to_pdf, slugified_title, preferences, previous = None, report = None, writes = None, source_future = None, shard_executor = None, backfill_db = False, shard_later = False):
+    '''Copy and process one PDF. Returns its manifest entry and the
+    counts from process_pdf (None when the PDF was skipped).
+
+    previous is the manifest entry from the last run, if any. When the
+    content hash or the annotation digest still matches it, no new notes
+    are written. Timings and counts are recorded in report.
+
+    The copy and the notes files are written through writes (a
+    pipeline.WriteBehind), which may still be writing them on return.
+    source_future is the source already being read ahead, if any.
+    A large PDF is only split into page ranges when shard_executor (the
+    run's process pool) is given; with shard_later (in a pool worker),
+    ShardLater is raised for such a PDF instead, once it turns out to need
+    new notes. With backfill_db, a PDF whose notes are current still
+    returns its annotation rows for the database.
+    '''
+    if report is None:
+        report = PdfReport(path_to_pdf, slugified_title)
+    if writes is None:
+        writes = WriteBehind()
     notes_path = preferences.notes_path
     image_size = preferences.image_size
     debug = preferences.debug
@@ -14,13 +77,397 @@ def prepare_pdf(path_to_pdf, slugified_title, preferences):
     if (not os.path.exists(path_to_notes)):
         os.mkdir(path_to_notes)
 
+    memory_guard = MemoryGuard(preferences.memory_limit_mb, path_to_pdf)
+    if memory_guard.low_memory:
+        print("    Large PDF, using low-memory mode")
+
+    # The source is read once; the same bytes are hashed, copied and opened
+    stat = os.stat(path_to_pdf)
+    with report.stage("read"):
+        if source_future is not None:
+            source = source_future.result()
+        else:
+            source = Source(path_to_pdf, keep_bytes = not memory_guard.low_memory)
+    report.count("bytes_read", stat.st_size)
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime, "slug": slugified_title, "hash": source.hash}
+
+    # The copy is only replaced when the source's content has changed since the last run
     path_to_pdf_copy = os.path.join(path_to_notes, f"{slugified_title}.pdf")
-    if (not os.path.exists(path_to_pdf_copy)):
-        shutil.copy(path_to_pdf, path_to_pdf_copy)
-    
-    process_pdf(path_to_pdf=path_to_pdf, path_to_pdf_copy = path_to_pdf_copy, path_to_notes = path_to_notes, image_size = image_size, debug = debug)
+    changed = previous is not None and previous.get("hash") not in (None, source.hash)
+    if changed or not os.path.exists(path_to_pdf_copy):
+        writes.call(copy_pdf, source, path_to_pdf_copy, preferences.pdf_copy, report)
+
+    notes_exist = os.path.exists(os.path.join(path_to_notes, "_index.md"))
+    if preferences.incremental and previous and notes_exist and previous.get("hash") == source.hash:
+        entry["annotations"] = previous.get("annotations")
+        print("    Unchanged")
+        report.status = "unchanged"
+        needs_catalog = preferences.catalog and not previous.get("catalog")
+        if previous.get("catalog"):
+            entry["catalog"] = previous["catalog"]
+        stats = None
+        if needs_catalog or backfill_db:
+            with source.open(fitz) as doc:
+                if needs_catalog:
+                    # Processed before the catalog was kept; only the metadata is read
+                    counts = Counter()
+                    annotation_digest(doc, counts = counts)
+                    entry["catalog"] = catalog_info(doc, slugified_title, counts["annotations"])
+                if backfill_db:
+                    stats = backfill_stats(doc, slugified_title, preferences, path_to_notes, report)
+        return entry, stats
+
+    with report.stage("open"):
+        doc = source.open(fitz)
+    # Closed here rather than left to the garbage collector, so long crawls
+    # don't pile up open documents
+    with doc:
+        record = AnnotationRecord(path_to_notes) if preferences.delta_notes else None
+        counts = Counter()
+        with report.stage("annotation_digest"):
+            entry["annotations"] = annotation_digest(doc, slugified_title, record, counts)
+        entry["catalog"] = catalog_info(doc, slugified_title, counts["annotations"])
+        if preferences.incremental and previous and notes_exist and previous.get("annotations") == entry["annotations"]:
+            if record is not None and record.previous is None:
+                record.save()
+            print("    Annotations unchanged")
+            report.status = "annotations unchanged"
+            return entry, backfill_stats(doc, slugified_title, preferences, path_to_notes, report) if backfill_db else None
+
+        # In delta mode, only what changed since the last notes file is written
+        delta = None
+        if record is not None and preferences.incremental and notes_exist:
+            delta = record.delta()
+            if delta is not None and not delta[0] and not delta[1]:
+                record.save()
+                print("    Annotations unchanged")
+                report.status = "annotations unchanged"
+                return entry, backfill_stats(doc, slugified_title, preferences, path_to_notes, report) if backfill_db else None
+            if delta is not None:
+                report.count("annotations_removed", len(delta[1]))
+
+        if shard_later and preferences.shard_min_pages and doc.page_count >= preferences.shard_min_pages:
+            raise ShardLater()
+
+        image_store = None
+        if preferences.dedupe_images:
+            image_store = ImageStore(notes_path, exclude = preferences.image_exclude)
+
+        image_filter = ImageFilter(
+            min_area = image_size,
+            max_aspect = preferences.image_max_aspect,
+            min_rendered = preferences.image_min_rendered,
+            margin = preferences.image_margin
+        )
+
+        word_cache = WordCache(notes_path, preferences.word_cache_mb) if preferences.word_cache_mb else None
+
+        snapshots = None
+        if preferences.annotation_snapshots:
+            snapshots = Snapshots(path_to_notes, preferences.snapshot_dpi, preferences.snapshot_max_pixels)
+
+        stats = process_pdf(path_to_pdf=path_to_pdf, path_to_pdf_copy = path_to_pdf_copy, path_to_notes = path_to_notes, image_size = image_size, debug = debug, doc = doc, image_store = image_store, image_threads = preferences.image_threads, image_filter = image_filter, collect_annotations = preferences.annotation_db, report = report, memory_guard = memory_guard, delta = delta, shard_workers = preferences.workers if shard_executor is not None else 1, shard_min_pages = preferences.shard_min_pages, word_cache = word_cache, writes = writes, snapshots = snapshots, shard_executor = shard_executor)
+        if backfill_db and "annotations_removed" in stats:
+            # The delta only has the changed annotations; the database needs them all
+            stats["annotations"] = backfill_stats(doc, slugified_title, preferences, path_to_notes, report)["annotations"]
+            del stats["annotations_removed"]
+        if record is not None:
+            writes.then(record.save)
+        if memory_guard.low_memory:
+            report.count("low_memory")
+    return entry, stats
+
+def safe_prepare_pdf(path_to_pdf, slugified_title, preferences, previous = None, io_pool = None, source_future = None, shard_executor = None, backfill_db = False, shard_later = False):
+    # A PDF that fails is reported and skipped so the rest of the run continues.
+    # Returns a PendingPdf; its result() is (ok, manifest entry, process_pdf counts, report as a dict)
+    report = PdfReport(path_to_pdf, slugified_title)
+    writes = WriteBehind(io_pool)
+    try:
+        with report.stage("total"), maybe_profile(path_to_pdf, slugified_title, preferences):
+            entry, stats = prepare_pdf(path_to_pdf, slugified_title, preferences, previous, report, writes, source_future, shard_executor, backfill_db, shard_later)
+        return PendingPdf(writes, True, entry, stats, report)
+    except ShardLater:
+        writes.wait()
+        raise
+    except Exception as e:
+        print(f"There was a problem processing {path_to_pdf}: {e}")
+        report.status = "failed"
+        report.error("prepare", e)
+        return PendingPdf(WriteBehind(), False, None, None, report)
+
+def _prepare_pdf_worker(path_to_pdf, slugified_title, preferences, previous, backfill_db = False):
+    # Runs in a pool process. Printed lines are captured and handed back so the
+    # parent can replay them in the same order as a serial run. Returns None
+    # for a PDF to be split, which the parent processes instead: a pool worker
+    # never starts a pool of its own
+    buffer = io.StringIO()
+    try:
+        with redirect_stdout(buffer):
+            result = safe_prepare_pdf(path_to_pdf, slugified_title, preferences, previous, backfill_db = backfill_db, shard_later = True).result()
+    except ShardLater:
+        return None
+    return result + (buffer.getvalue(),)
+
+def find_pdfs(pdfs_path, earliest_modified_date = None, walker = None):
+    # walker is a PdfWalker with the include/exclude settings; by default every PDF under pdfs_path
+    if walker is None:
+        walker = PdfWalker(pdfs_path)
+    for path_to_pdf, stat in walker:
+        if earliest_modified_date is None or datetime.fromtimestamp(stat.st_mtime) > earliest_modified_date:
+            yield path_to_pdf, pdf_slug(path_to_pdf)
+
+def cached_stat(path_to_pdf, stats):
+    stat = stats.get(path_to_pdf) if stats else None
+    return stat if stat is not None else os.stat(path_to_pdf)
+
+def filter_current(pdfs, preferences, manifest, stats = None, catalog = None, db = None):
+    # Drop PDFs whose size and mtime match the manifest without opening them,
+    # unless they are still missing from the catalog or the annotation database
+    for path_to_pdf, slugified_title in pdfs:
+        path_to_notes = os.path.join(preferences.notes_path, slugified_title)
+        if manifest.is_current(path_to_pdf, cached_stat(path_to_pdf, stats), path_to_notes) and (catalog is None or catalog.has(slugified_title)) and (db is None or db.has_pdf(slugified_title)):
+            continue
+        yield path_to_pdf, slugified_title
+
+def skip_duplicates(pdfs, manifest, skipped, stats = None):
+    # Drop copies of other PDFs and slug collisions, adding them to skipped
+    finder = DuplicateFinder(manifest)
+    for path_to_pdf, slugified_title in pdfs:
+        found = finder.check(path_to_pdf, slugified_title, cached_stat(path_to_pdf, stats).st_size)
+        if found:
+            reason, other = found
+            print(f"Skipping {path_to_pdf}: {reason} with {other}")
+            skipped.append((path_to_pdf, slugified_title, reason, other))
+            continue
+        yield path_to_pdf, slugified_title
+
+def add_stats(totals, ok, stats, report, slugified_title, db = None):
+    totals["reports"].append(report)
+    if not ok:
+        totals["failed"] += 1
+    if stats:
+        totals["images_filtered"].update(stats["images_filtered"])
+        if db is not None and "annotations_removed" in stats:
+            db.update_pdf(slugified_title, stats["annotations"], stats["annotations_removed"])
+        elif db is not None and "annotations" in stats:
+            db.replace_pdf(slugified_title, stats["annotations"])
+
+def needs_backfill(db, slugified_title):
+    return db is not None and not db.has_pdf(slugified_title)
+
+def record_pdf(manifest, journal, catalog, path_to_pdf, ok, entry):
+    # Once a PDF's notes are on disk: its manifest entry, checkpoint and catalog entry
+    manifest.update(path_to_pdf, entry)
+    if journal is not None:
+        journal.done(path_to_pdf, ok, entry)
+    if catalog is not None:
+        catalog.update(path_to_pdf, entry)
+
+def new_totals():
+    return {"found": 0, "done": 0, "failed": 0, "images_filtered": Counter(), "reports": []}
+
+def cancelled(cancel):
+    return cancel is not None and cancel.is_set()
+
+def progress_total(pdfs, totals):
+    # A streamed run doesn't know its total yet; use the PDFs found so far
+    return len(pdfs) if isinstance(pdfs, list) else totals["found"]
+
+def run_serial(pdfs, preferences, manifest, progress = None, cancel = None, db = None, journal = None, catalog = None):
+    totals = new_totals()
+    io_threads = preferences.io_threads
+    if not io_threads:
+        # Every step of every PDF in strict sequence
+        for path_to_pdf, slugified_title in pdfs:
+            if cancelled(cancel):
+                break
+            totals["found"] += 1
+            if journal is not None:
+                journal.started(path_to_pdf, slugified_title)
+            ok, entry, stats, report = safe_prepare_pdf(path_to_pdf, slugified_title, preferences, manifest.get(path_to_pdf), backfill_db = needs_backfill(db, slugified_title)).result()
+            record_pdf(manifest, journal, catalog, path_to_pdf, ok, entry)
+            add_stats(totals, ok, stats, report, slugified_title, db)
+            totals["done"] += 1
+            if progress:
+                progress(totals["done"], progress_total(pdfs, totals))
+        return totals
+
+    # Pipelined: the next PDFs are read on the I/O threads, and the last
+    # PDFs' copies and notes written there, while this thread extracts
+    written = deque()
+
+    def collect(wait):
+        while written and (wait or written[0][2].done()):
+            path_to_pdf, slugified_title, pending = written.popleft()
+            ok, entry, stats, report = pending.result()
+            record_pdf(manifest, journal, catalog, path_to_pdf, ok, entry)
+            add_stats(totals, ok, stats, report, slugified_title, db)
+            totals["done"] += 1
+            if progress:
+                progress(totals["done"], progress_total(pdfs, totals))
+
+    with ThreadPoolExecutor(max_workers = io_threads) as io_pool:
+        sources = prefetch_sources(pdfs, io_pool, PIPELINE_DEPTH, preferences.memory_limit_mb)
+        for path_to_pdf, slugified_title, source_future in sources:
+            if cancelled(cancel):
+                # Stop reading ahead; the PDFs already handed out are still written
+                source_future.cancel()
+                sources.close()
+                break
+            totals["found"] += 1
+            if journal is not None:
+                journal.started(path_to_pdf, slugified_title)
+            pending = safe_prepare_pdf(path_to_pdf, slugified_title, preferences, manifest.get(path_to_pdf), io_pool, source_future, backfill_db = needs_backfill(db, slugified_title))
+            written.append((path_to_pdf, slugified_title, pending))
+            collect(wait = len(written) > PIPELINE_DEPTH)
+        collect(wait = True)
+    return totals
+
+def run_parallel(pdfs, preferences, manifest, progress = None, cancel = None, db = None, journal = None, catalog = None):
+    totals = new_totals()
+    submitted = deque()
+
+    def collect(wait):
+        # Results are collected in submission order, so the log reads like a serial run
+        while submitted and (wait or submitted[0][2].done()):
+            path_to_pdf, slugified_title, future = submitted.popleft()
+            if cancelled(cancel):
+                # PDFs already running finish and are recorded; the rest never start
+                future.cancel()
+                for pending in submitted:
+                    pending[2].cancel()
+            if future.cancelled():
+                if journal is not None:
+                    journal.cancelled(path_to_pdf)
+                continue
+            result = future.result()
+            if result is None:
+                # Big enough to split: processed here, its page ranges spread
+                # over the pool behind the PDFs already handed out
+                result = safe_prepare_pdf(path_to_pdf, slugified_title, preferences, manifest.get(path_to_pdf), shard_executor = executor, backfill_db = needs_backfill(db, slugified_title)).result() + ("",)
+            ok, entry, stats, report, output = result
+            print(output, end="")
+            record_pdf(manifest, journal, catalog, path_to_pdf, ok, entry)
+            add_stats(totals, ok, stats, report, slugified_title, db)
+            totals["done"] += 1
+            if progress:
+                progress(totals["done"], progress_total(pdfs, totals))
+
+    with ProcessPoolExecutor(max_workers = preferences.workers) as executor:
+        # When pdfs is a generator still walking the tree, workers start on
+        # the first PDFs while the rest are being found
+        for path_to_pdf, slugified_title in pdfs:
+            if cancelled(cancel):
+                break
+            totals["found"] += 1
+            if journal is not None:
+                journal.started(path_to_pdf, slugified_title)
+            future = executor.submit(_prepare_pdf_worker, path_to_pdf, slugified_title, preferences, manifest.get(path_to_pdf), needs_backfill(db, slugified_title))
+            submitted.append((path_to_pdf, slugified_title, future))
+            collect(wait = False)
+        collect(wait = True)
+    return totals
+
+def pdf_slug(path_to_pdf):
+    return text_utils.slugify(os.path.splitext(os.path.basename(path_to_pdf))[0])
+
+def process_pdfs(pdfs, preferences, progress = None, cancel = None, stats = None):
+    '''Process (path_to_pdf, slugified_title) pairs.
+    PDFs that the manifest shows as unchanged are skipped, and so are
+    copies of another PDF and PDFs whose slug another PDF already uses.
+
+    pdfs is read to the end before the first PDF is processed, unless
+    preferences.stream_discovery is set. stats is an optional
+    {path: os.stat_result} for PDFs already stat'ed while being found.
+
+    Progress is checkpointed in a journal. PDFs finished by an interrupted
+    run are added to the manifest; with preferences.resume they are not
+    processed again either, whether or not the run is incremental.
+    '''
+    notes_path = preferences.notes_path
+    started = datetime.now().strftime("%Y%m%d-%H%M%S")
+    manifest = Manifest(notes_path)
+    catalog = Catalog(notes_path) if preferences.catalog else None
+    journal = Journal(notes_path)
+    # Only this process writes to the database; workers hand back their rows
+    db = AnnotationDB(notes_path) if preferences.annotation_db else None
+    crashed = []
+    if journal.interrupted:
+        print(f"The last run was interrupted after {len(journal.finished)} PDF(s); their notes are kept")
+        journal.restore(manifest)
+        if catalog is not None:
+            for path_to_pdf, entry in journal.finished.items():
+                catalog.update(path_to_pdf, entry)
+    if preferences.incremental:
+        pdfs = filter_current(pdfs, preferences, manifest, stats, catalog, db)
+    if preferences.resume:
+        pdfs = journal.skip_done(pdfs, crashed, stats)
+    skipped = []
+    pdfs = skip_duplicates(pdfs, manifest, skipped, stats)
+    if not preferences.stream_discovery:
+        pdfs = list(pdfs)
+        if progress:
+            progress(0, len(pdfs))
+    elif preferences.io_threads and not (preferences.workers and preferences.workers > 1):
+        # Keep searching on a thread of its own; a parallel run already
+        # searches between handing out PDFs
+        pdfs = threaded(pdfs, PIPELINE_DEPTH * 8)
+
+    journal.open(preferences.resume)
+    totals = None
+    try:
+        if preferences.workers and preferences.workers > 1:
+            totals = run_parallel(pdfs, preferences, manifest, progress, cancel, db, journal, catalog)
+        else:
+            totals = run_serial(pdfs, preferences, manifest, progress, cancel, db, journal, catalog)
+    finally:
+        manifest.save()
+        if catalog is not None and catalog.save():
+            print(f"Catalog updated: {catalog.path}")
+        # Kept for --resume unless every PDF was got through
+        journal.close(complete = totals is not None and not cancelled(cancel))
+        if db is not None:
+            db.close()
+        # Only a run that added entries can have taken the cache over its limit
+        if preferences.word_cache_mb and totals is not None and any(report["counts"].get("word_cache_misses") for report in totals["reports"]):
+            WordCache(notes_path, preferences.word_cache_mb).trim()
+
+    if cancelled(cancel):
+        print(f"Cancelled after {totals['done']} of {progress_total(pdfs, totals)} PDF(s)")
+
+    filtered = totals["images_filtered"]
+    if filtered:
+        reasons = ", ".join(f"{reason}: {count}" for reason, count in sorted(filtered.items()))
+        print(f"{sum(filtered.values())} image(s) filtered before decoding ({reasons})")
+    if totals["failed"]:
+        print(f"{totals['failed']} PDF(s) could not be processed")
+    if skipped:
+        print(f"{len(skipped)} PDF(s) skipped as duplicates or slug collisions")
+    for path_to_pdf, slugified_title, reason, other in skipped:
+        report = PdfReport(path_to_pdf, slugified_title)
+        report.status = f"{reason} with {other}"
+        totals["reports"].append(report.as_dict())
+    if crashed:
+        print(f"{len(crashed)} PDF(s) skipped after being in progress when earlier runs stopped")
+    for path_to_pdf, slugified_title, attempts in crashed:
+        report = PdfReport(path_to_pdf, slugified_title)
+        report.status = f"in progress when {attempts} runs stopped"
+        totals["reports"].append(report.as_dict())
+    errors = sum(len(report["errors"]) for report in totals["reports"])
+    if errors:
+        print(f"{errors} error(s) were recorded while processing")
+    if preferences.report_format and totals["reports"]:
+        path = write_run_report(notes_path, totals["reports"], started, preferences.report_format, preferences.keep_reports)
+        print(f"Run report: {path}")
+    return totals
+
+def crawl(preferences, progress = None, cancel = None):
+    '''Process every PDF under preferences.pdfs_path.
 
-def crawl(preferences):
+    progress, if given, is called as progress(done, total) after each PDF.
+    cancel is an optional threading.Event; once set, the run stops before
+    the next PDF.
+    '''
     # Both paths should exist before proceeding
     notes_path = preferences.notes_path
     pdfs_path = preferences.pdfs_path
@@ -37,15 +484,6 @@ def crawl(preferences):
         except:
             earliest_modified_date = None
 
-        for dirpath, dirnames, filenames in os.walk(pdfs_path):
-            for file in filenames:
-                ext = os.path.splitext(file)
-                if ext[-1] == '.pdf':
-                    path_to_pdf = os.path.abspath(os.path.join(dirpath, file))
-                    slugified_title = text_utils.slugify(ext[0])
-
-                    if earliest_modified_date is not None:
-                        if datetime.fromtimestamp(os.stat(path_to_pdf).st_mtime) > earliest_modified_date:
-                            prepare_pdf(path_to_pdf, slugified_title, preferences)
-                    else:
-                        prepare_pdf(path_to_pdf, slugified_title, preferences)
\ No newline at end of file
+        walker = PdfWalker(pdfs_path, preferences.include, preferences.exclude, preferences.max_depth, notes_path)
+        pdfs = find_pdfs(pdfs_path, earliest_modified_date, walker)
+        process_pdfs(pdfs, preferences, progress, cancel, walker.stats)
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+RECORD_NAME = ".pdref-annotations.json"
+RECORD_VERSION = 1
+
+# Characters of an annotation's comment kept to describe it once it's removed
+PREVIEW_LENGTH = 60
+
+
+def annotation_hash(annot):
+    'Changes when what the notes show for an annotation would change'
+    rect = tuple(round(v, 1) for v in annot.rect)
+    content = repr((annot.type[0], rect, annot.info['content']))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+class AnnotationRecord:
+    '''The annotations written to a PDF's notes on earlier runs.
+
+    Kept as <notes>/<slug>/.pdref-annotations.json, mapping each annotation
+    id (see annotationdb.annotation_id) to [page, content hash, preview].
+    current is filled while the PDF is read (by annotation_digest); delta()
+    compares the two.
+    '''
+
+    def __init__(self, path_to_notes):
+        self.path = os.path.join(path_to_notes, RECORD_NAME)
+        self.previous = None
+        self.current = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == RECORD_VERSION:
+            self.previous = data.get("annotations", {})
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"version": RECORD_VERSION, "annotations": self.current}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def add(self, id, page, annot):
+        self.current[id] = [page, annotation_hash(annot), annot.info['content'][:PREVIEW_LENGTH]]
+
+    def delta(self):
+        '''Returns ({id: "added" or "changed"}, removed) where removed is a
+        list of (id, page, preview), or None when there is no earlier record.
+        '''
+        if self.previous is None:
+            return None
+        changed = {}
+        for id, (page, digest, preview) in self.current.items():
+            before = self.previous.get(id)
+            if before is None:
+                changed[id] = "added"
+            elif before[1] != digest:
+                changed[id] = "changed"
+        removed = sorted(
+            ((id, page, preview) for id, (page, digest, preview) in self.previous.items() if id not in self.current),
+            key=lambda r: r[1]
+        )
+        return changed, removed
@@ -1,26 +1,81 @@
 import sys
+import multiprocessing
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import scrolledtext
-from crawl import crawl
+from tkinter import ttk
 from datetime import datetime, timedelta
 from userpreferences import UserPreferences
 
+# How often the window picks up output and progress from the worker thread
+POLL_MS = 100
+
 class MessageRedirector(object):
-    def __init__(self, text_output):
-        self.output = text_output
+    # print() may be called from the worker thread, which must not touch Tk.
+    # Text is queued and written to the console in batches by poll_events()
+    def __init__(self, events):
+        self.events = events
     
     def write(self, string):
-        self.output.configure(state = 'normal')
-        self.output.insert(tk.END, string)
-        self.output.configure(state = 'disabled')
-        self.output.see('end')
+        self.events.put(("text", string))
 
     def flush(self):
         pass
 
+def poll_events():
+    text = []
+    try:
+        while True:
+            kind, value = events.get_nowait()
+            if kind == "text":
+                text.append(value)
+            elif kind == "progress":
+                done, total = value
+                progressbar_run.configure(maximum = max(total, 1), value = done)
+                bar_status.config(text = f"Running... {done}/{total}")
+            elif kind == "done":
+                finish_run()
+    except queue.Empty:
+        pass
+
+    if text:
+        scrolledtext_console.configure(state = 'normal')
+        scrolledtext_console.insert(tk.END, "".join(text))
+        scrolledtext_console.configure(state = 'disabled')
+        scrolledtext_console.see('end')
+        show_output()
+
+    root.after(POLL_MS, poll_events)
+
+def run_crawl(preferences):
+    # Worker thread. crawl (and with it PyMuPDF) is imported here rather than
+    # at the top, so the window appears without waiting for it to load
+    try:
+        from crawl import crawl
+        crawl(preferences, progress = lambda done, total: events.put(("progress", (done, total))), cancel = cancel_event)
+    except Exception as e:
+        print(f"The run stopped with an error: {e}")
+    finally:
+        events.put(("done", None))
+
+def finish_run():
+    global worker
+    worker = None
+    bar_status.config(text = "Cancelled" if cancel_event.is_set() else "Done!")
+    button_run.configure(state = 'normal')
+    button_cancel.configure(state = 'disabled')
+    show_output()
+
+def cancel():
+    if worker is not None:
+        cancel_event.set()
+        bar_status.config(text = "Cancelling after the current PDF...")
+        button_cancel.configure(state = 'disabled')
+
 def show_output():
-    if (root.winfo_height() < 250):
+    if (root.winfo_height() < 290):
         w = root.winfo_width()
         h = 400
         root.geometry(f'{w}x{h}')
@@ -31,6 +86,10 @@ def select_folder(entry):
     entry.insert(0, folder_path)
 
 def run():
+    global worker
+    if worker is not None:
+        return
+
     # Check file input
     refs_path = entry_refs.get()
     notes_path = entry_notes.get()
@@ -47,20 +106,25 @@ def run():
         show_output()
         return
     else:
-        # Run
+        # Run on a worker thread so the window stays responsive
         bar_status.config(text = "Running...")
-        root.update()
+        button_run.configure(state = 'disabled')
+        button_cancel.configure(state = 'normal')
+        progressbar_run.configure(value = 0)
+        cancel_event.clear()
         preferences = UserPreferences(pdfs_path=refs_path, notes_path=notes_path, earliest_modified_date=earliest_modified_date)
-        crawl(preferences)
-        bar_status.config(text = "Done!")
-        show_output()
+        worker = threading.Thread(target = run_crawl, args = (preferences,), daemon = True)
+        worker.start()
         return
 
 if __name__ == '__main__':
+    # Needed for process pools in the frozen (pyinstaller) build
+    multiprocessing.freeze_support()
+
     # Set up window
     root = tk.Tk()
     root.title('pdref')
-    root.geometry('300x210+200+200')
+    root.geometry('300x250+200+200')
     root.minsize(200, 160)
     root.iconbitmap('res/icon.ico')
     root.columnconfigure(0,weight=1)
@@ -115,11 +179,19 @@ if __name__ == '__main__':
     # Run options
     button_run = tk.Button(frame_run, text = 'Run', command = run, padx=10, pady=10)
     button_run.grid(column=0, row = 0, padx=10, pady=10, sticky=tk.EW)
+    button_cancel = tk.Button(frame_run, text = 'Cancel', command = cancel, padx=10, pady=10, state = 'disabled')
+    button_cancel.grid(column=1, row = 0, padx=10, pady=10, sticky=tk.EW)
+    progressbar_run = ttk.Progressbar(frame_run, orient = tk.HORIZONTAL, mode = 'determinate')
+    progressbar_run.grid(column=0, row = 1, columnspan = 2, padx=10, sticky=tk.EW)
 
     # Configure stdout scroll view
     scrolledtext_console = scrolledtext.ScrolledText(frame_stdout, height = 1)
     scrolledtext_console.grid(padx=5, pady=5, sticky=tk.NSEW)
-    sys.stdout = MessageRedirector(scrolledtext_console)
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    worker = None
+    sys.stdout = MessageRedirector(events)
+    root.after(POLL_MS, poll_events)
 
     # Bottom info
     bar_status = tk.Label(frame_info, text=(f"pdref v0.1.2"), bd=1, relief=tk.SUNKEN, anchor='w')
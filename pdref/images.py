@@ -0,0 +1,352 @@
+import hashlib
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import fitz
+
+STORE_NAME = ".pdref-images"
+# Empty file in the store, linked into the notes folder to see whether hardlinks work there
+LINK_PROBE = ".link-probe"
+
+# Streams with these filters are already a standalone image file
+PASSTHROUGH_FILTERS = {"/DCTDecode": "jpg", "/JPXDecode": "jpx"}
+PASSTHROUGH_COLORSPACES = ("DeviceRGB", "DeviceGray", "CalRGB", "CalGray", "ICCBased")
+ICC_PROFILE = re.compile(r"/ICCBased\s+(\d+)\s+\d+\s+R")
+
+PNG_COLOR_TYPES = {(1, False): 0, (3, False): 2, (2, True): 4, (4, True): 6}
+
+
+def image_key(doc, img):
+    """Return a content hash for an entry of doc.get_page_images().
+    The raw (still compressed) stream is hashed, so no pixels are decoded.
+    """
+    xref, smask, width, height, bpc, colorspace = img[:6]
+    h = hashlib.sha256(repr((width, height, bpc, colorspace)).encode('utf-8'))
+    h.update(doc.xref_stream_raw(xref))
+    return h.hexdigest()
+
+
+def icc_components(doc, xref):
+    'Number of colour components of an ICCBased image, from its profile\'s /N'
+    kind, value = doc.xref_get_key(xref, "ColorSpace")
+    if kind == "xref":
+        # The [/ICCBased n 0 R] array is an object of its own
+        kind, value = "array", doc.xref_object(int(value.split()[0]), compressed = True)
+    match = ICC_PROFILE.search(value) if kind == "array" else None
+    if match:
+        kind, n = doc.xref_get_key(int(match.group(1)), "N")
+        if kind == "int":
+            return int(n)
+    # Unusual layouts: ask MuPDF, which decodes the image
+    return fitz.Pixmap(doc, xref).colorspace.n
+
+
+def image_extension(doc, img):
+    """Return the file extension an image will be saved with.
+    JPEG and JPEG 2000 streams in grey or RGB are written as they are;
+    everything else (including CMYK behind an ICC profile, and images with
+    a /Decode array) is decoded and saved as PNG.
+    """
+    xref, colorspace = img[0], img[5]
+    if colorspace in PASSTHROUGH_COLORSPACES:
+        kind, value = doc.xref_get_key(xref, "Filter")
+        if kind == "name" and value in PASSTHROUGH_FILTERS:
+            if doc.xref_get_key(xref, "Decode")[0] != "null":
+                return "png"
+            if colorspace == "ICCBased" and icc_components(doc, xref) not in (1, 3):
+                return "png"
+            return PASSTHROUGH_FILTERS[value]
+    return "png"
+
+
+class ImageFilter:
+    '''Decides from metadata alone whether an image is worth saving.
+
+    Uses the width and height from doc.get_page_images() and the image's
+    placement on the page, so rejected images are never decoded. Every
+    option is off when None:
+
+    min_area: minimum width * height in pixels
+    max_aspect: maximum ratio of the long side to the short side
+    min_rendered: minimum width and height as drawn on the page, in points
+    margin: images drawn entirely within this distance (in points) of the
+        page edges are left out
+    '''
+
+    def __init__(self, min_area = None, max_aspect = None, min_rendered = None, margin = None):
+        self.min_area = min_area
+        self.max_aspect = max_aspect
+        self.min_rendered = min_rendered
+        self.margin = margin
+        self.counts = Counter()
+
+    def intrinsic_reason(self, img):
+        'Reason to leave out the image wherever it appears, or None'
+        width, height = img[2], img[3]
+        if self.min_area and width * height < self.min_area:
+            return "area"
+        if self.max_aspect and max(width, height) > self.max_aspect * max(min(width, height), 1):
+            return "aspect"
+        return None
+
+    def placement_reason(self, page, img):
+        'Reason to leave out the image on this page, or None'
+        if not (self.min_rendered or self.margin):
+            return None
+        rects = [r for r in page.get_image_rects(img[0]) if not r.is_empty]
+        if not rects:
+            return None  # placement unknown (e.g. drawn inside a form), keep it
+        if self.min_rendered and all(min(r.width, r.height) < self.min_rendered for r in rects):
+            return "rendered size"
+        if self.margin:
+            inner = page.rect + (self.margin, self.margin, -self.margin, -self.margin)
+            if all(not r.intersects(inner) for r in rects):
+                return "margin"
+        return None
+
+    def count(self, reason):
+        self.counts[reason] += 1
+
+
+def load_exclusions(path):
+    """Return the set of image hashes to leave out.
+    path is either a text file with one hash per line, or a reference
+    directory of images taken from the image store (named <hash>.<ext>).
+    """
+    if not path:
+        return set()
+    if os.path.isdir(path):
+        return {os.path.splitext(name)[0] for name in os.listdir(path)}
+    with open(path, "r", encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith("#")}
+
+
+def decode_pixmap(doc, xref):
+    """Return (samples, width, height, n, alpha, stride) ready for encode_png,
+    or None if the image can't be saved. Anything that isn't gray or RGB
+    (CMYK, indexed, Lab, ...) is converted to RGB.
+    """
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace is None:
+        return None  # stencil masks have no colors of their own
+    if pix.colorspace.n not in (1, 3):
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix.samples, pix.w, pix.h, pix.n, bool(pix.alpha), pix.stride
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+
+
+def encode_png(samples, width, height, n, alpha, stride, level = 6):
+    # Pure Python PNG writer; the work is in zlib, which releases the GIL,
+    # so several of these can run at once on the encoder threads
+    color_type = PNG_COLOR_TYPES[(n, alpha)]
+    rows = b"".join(b"\x00" + samples[y*stride:y*stride + width*n] for y in range(height))
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(rows, level)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+def write_file(path, data):
+    # Write under a private name first so readers never see half a file
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def copy_file(source, destination):
+    # Copied under a private name first, like write_file
+    tmp_path = f"{destination}.{os.getpid()}-{threading.get_ident()}.tmp"
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def link_or_copy(source, destination):
+    if os.path.exists(destination):
+        return
+    try:
+        os.link(source, destination)
+    except OSError:
+        copy_file(source, destination)
+
+
+def try_link(source, destination):
+    'Hardlink source to destination if it isn\'t there yet; returns whether destination exists'
+    if os.path.exists(destination):
+        return True
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    return True
+
+
+def hardlinks_supported(folder, destination_folder):
+    'Whether a file in folder can be hardlinked into destination_folder'
+    probe = os.path.join(folder, LINK_PROBE)
+    link = os.path.join(destination_folder, f"{LINK_PROBE}.{os.getpid()}-{threading.get_ident()}")
+    try:
+        if not os.path.exists(probe):
+            write_file(probe, b"")
+        os.link(probe, link)
+    except OSError:
+        return False
+    try:
+        os.remove(link)
+    except OSError:
+        pass
+    return True
+
+
+class ImageWriter:
+    '''Encodes and writes images on a bounded thread pool.
+
+    Pixmaps are decoded on the calling thread (PyMuPDF is not thread safe);
+    only PNG encoding and file writes run on the pool. At most twice as
+    many images as threads are held in memory at a time, after which
+    submit() waits for a slot.
+    '''
+
+    def __init__(self, threads = 2):
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads else None
+        self.slots = threading.BoundedSemaphore(max(threads, 1) * 2)
+        self.futures = []
+        self.errors = []
+        self.bytes_written = 0
+
+    def submit(self, fn, *args):
+        if self.executor is None:
+            try:
+                self.bytes_written += fn(*args) or 0
+            except Exception as e:
+                self.errors.append(e)
+            return None
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        'Wait for every image to be written. Returns the errors raised.'
+        for future in self.futures:
+            error = future.exception()
+            if error is not None:
+                self.errors.append(error)
+            else:
+                self.bytes_written += future.result() or 0
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+        return self.errors
+
+
+# Pool tasks return the number of bytes they wrote
+
+def _encode_and_write(decoded, path):
+    return write_file(path, encode_png(*decoded))
+
+
+def _store_and_link(decoded, raw, stored, image_path):
+    if decoded is not None:
+        written = write_file(stored, encode_png(*decoded))
+    else:
+        written = write_file(stored, raw)
+    if image_path is not None:
+        link_or_copy(stored, image_path)
+    return written
+
+
+def _link_after(future, stored, image_path):
+    future.result()
+    link_or_copy(stored, image_path)
+    return 0
+
+
+class ImageStore:
+    '''Content-addressed store for extracted images, shared by the notes tree.
+
+    Each distinct image is written once, into
+    <notes>/.pdref-images/<hash>.<ext>. The file in a PDF's notes folder is a
+    hardlink to it, so a watermark repeated across hundreds of PDFs is
+    stored once. Where hardlinks aren't supported, or linking an image
+    already stored fails (e.g. it has too many links), the notes reference
+    the stored file itself rather than a copy.
+    '''
+
+    def __init__(self, notes_path, exclude = None):
+        self.path = os.path.join(notes_path, STORE_NAME)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        self.excluded = load_exclusions(exclude)
+        self.pending = {}
+        self.hardlinks = hardlinks_supported(self.path, notes_path)
+
+    def is_excluded(self, key):
+        return key in self.excluded
+
+    def stored_path(self, key, ext):
+        return os.path.join(self.path, f"{key}.{ext}")
+
+    def stored_reference(self, key, ext):
+        # Relative to a PDF's notes folder, which is next to the store
+        return f"../{STORE_NAME}/{key}.{ext}"
+
+    def save(self, doc, img, ext, key, image_path, writer):
+        '''Store the image and link it to image_path. Returns the Markdown
+        reference to use (the file name, or the stored file when it can't
+        be linked), or None if the image couldn't be saved.
+        '''
+        stored = self.stored_path(key, ext)
+        reference = os.path.basename(image_path) if self.hardlinks else self.stored_reference(key, ext)
+        if stored in self.pending:
+            if self.hardlinks:
+                writer.submit(_link_after, self.pending[stored], stored, image_path)
+            return reference
+        if os.path.exists(stored):
+            if self.hardlinks and not try_link(stored, image_path):
+                return self.stored_reference(key, ext)
+            return reference
+        decoded, raw = None, None
+        if ext == "png":
+            decoded = decode_pixmap(doc, img[0])
+            if decoded is None:
+                return None
+        else:
+            raw = doc.xref_stream_raw(img[0])
+        future = writer.submit(_store_and_link, decoded, raw, stored, image_path if self.hardlinks else None)
+        if future is not None:
+            self.pending[stored] = future
+        return reference
+
+
+def save_image(doc, img, ext, image_path, writer):
+    'Write one image to image_path without going through a store'
+    if ext == "png":
+        decoded = decode_pixmap(doc, img[0])
+        if decoded is None:
+            return False
+        writer.submit(_encode_and_write, decoded, image_path)
+    else:
+        writer.submit(write_file, image_path, doc.xref_stream_raw(img[0]))
+    return True
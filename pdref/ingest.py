@@ -0,0 +1,128 @@
+import hashlib
+import os
+from collections import defaultdict
+from images import copy_file, write_file
+from manifest import file_hash
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# From <linux/fs.h>: share the source file's blocks with the destination
+FICLONE = 0x40049409
+
+# Larger PDFs aren't held in memory: fitz.open keeps the buffer alive, and a
+# pipelined run has several PDFs in flight at once
+KEEP_BYTES_MB = 32
+
+
+class Source:
+    '''A source PDF read once from disk.
+
+    data holds the file's bytes, for both the copy in the notes folder and
+    fitz.open, and hash is their sha256. With keep_bytes False, or for a
+    file over KEEP_BYTES_MB, the file is hashed in chunks instead and data
+    is None, so it is opened (and copied) from its path.
+    '''
+
+    def __init__(self, path, keep_bytes = True):
+        self.path = path
+        self.data = None
+        if keep_bytes and os.path.getsize(path) <= KEEP_BYTES_MB * 1024 * 1024:
+            with open(path, "rb") as f:
+                self.data = f.read()
+            self.hash = hashlib.sha256(self.data).hexdigest()
+        else:
+            self.hash = file_hash(path)
+
+    def open(self, fitz):
+        if self.data is not None:
+            return fitz.open(stream=self.data, filetype="pdf")
+        return fitz.open(self.path)
+
+
+def reflink(source, destination):
+    'Copy-on-write clone of source (Btrfs, XFS, ...); raises OSError where unsupported'
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    try:
+        with open(source, "rb") as s, open(tmp_path, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        os.replace(tmp_path, destination)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def hardlink(source, destination):
+    tmp_path = f"{destination}.{os.getpid()}.tmp"
+    os.link(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def place_copy(source, destination, mode = "clone"):
+    '''Put a copy of a Source at destination; returns how it was made.
+
+    mode "clone" tries a copy-on-write reflink, "hardlink" tries a hard
+    link first (edits to either file then show up in both), and "copy"
+    always writes the bytes. Anything that fails falls back to writing
+    the bytes already in memory, so the source is never read again.
+    '''
+    attempts = {"hardlink": (hardlink, reflink), "clone": (reflink,), "copy": ()}.get(mode, (reflink,))
+    for attempt in attempts:
+        try:
+            attempt(source.path, destination)
+            return attempt.__name__
+        except OSError:
+            continue
+    if source.data is not None:
+        write_file(destination, source.data)
+    else:
+        copy_file(source.path, destination)
+    return "copy"
+
+
+class DuplicateFinder:
+    '''Spots PDFs that shouldn't be processed alongside the others.
+
+    A PDF is a slug collision when another source still on disk already
+    uses its slug (its notes would overwrite the other's), and a duplicate
+    when it has the same content as another source. PDFs are checked one
+    at a time, as they are found, against the manifest and the PDFs
+    checked before them. Only files whose size matches another file are
+    hashed, so in most libraries nothing is read.
+    '''
+
+    def __init__(self, manifest):
+        known = {path: entry for path, entry in manifest.entries.items() if os.path.exists(path)}
+        self.slug_owner = {entry.get("slug"): path for path, entry in known.items() if entry.get("slug")}
+        # size -> {path: hash, or None until it is needed}
+        self.by_size = defaultdict(dict)
+        for path, entry in known.items():
+            if entry.get("hash"):
+                self.by_size[entry.get("size")][path] = entry["hash"]
+
+    def check(self, path_to_pdf, slugified_title, size):
+        'Returns (reason, other path) for a PDF to skip, or None'
+        owner = self.slug_owner.get(slugified_title)
+        if owner is not None and owner != path_to_pdf:
+            return "slug collision", owner
+
+        same_size = self.by_size[size]
+        digest = None
+        for path in list(same_size):
+            if path == path_to_pdf:
+                continue
+            if digest is None:
+                digest = file_hash(path_to_pdf)
+            if same_size[path] is None:
+                same_size[path] = file_hash(path)
+            if same_size[path] == digest:
+                return "duplicate", path
+
+        self.slug_owner[slugified_title] = path_to_pdf
+        same_size[path_to_pdf] = digest
+        return None
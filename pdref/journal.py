@@ -0,0 +1,132 @@
+import json
+import os
+from collections import Counter
+
+JOURNAL_NAME = ".pdref-journal.jsonl"
+
+# A PDF that was being processed when this many runs in a row stopped is
+# skipped by a resumed run; it is most likely what stopped them
+MAX_ATTEMPTS = 2
+
+
+def remove_stale_tmp(path_to_notes):
+    'Remove temporary files left in a PDF\'s notes folder by a run that was killed'
+    for folder in (path_to_notes, os.path.join(path_to_notes, "notes")):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(".tmp") and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class Journal:
+    '''Checkpoints of the run in progress, kept in the notes folder as
+    .pdref-journal.jsonl until the run finishes.
+
+    One JSON line is written when a PDF is handed out and another, with its
+    manifest entry, once its notes are on disk; each is synced straight
+    away, so a run that is killed still leaves a record of every PDF it
+    finished. A journal found at the start of a run means the last run
+    was interrupted: its finished entries are added to the manifest and,
+    when resuming, those PDFs are not processed again.
+    '''
+
+    def __init__(self, notes_path):
+        self.path = os.path.join(notes_path, JOURNAL_NAME)
+        self.notes_path = notes_path
+        # path -> manifest entry (None when the PDF failed)
+        self.finished = {}
+        # path -> times it was in progress when a run stopped
+        self.attempts = Counter()
+        self.interrupted = os.path.exists(self.path)
+        self.file = None
+        if self.interrupted:
+            self.load()
+
+    def load(self):
+        started = Counter()
+        slugs = {}
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The last line of a killed run may be cut short
+                continue
+            path_to_pdf = event.get("pdf")
+            if event.get("event") == "started":
+                started[path_to_pdf] += 1
+                slugs[path_to_pdf] = event.get("slug")
+            elif event.get("event") == "finished":
+                self.finished[path_to_pdf] = event.get("entry") if event.get("ok") else None
+                started.pop(path_to_pdf, None)
+            elif event.get("event") == "cancelled":
+                started[path_to_pdf] -= 1
+        self.attempts = +started
+        # Only PDFs that were being written can have left partial files
+        for path_to_pdf in self.attempts:
+            if slugs.get(path_to_pdf):
+                remove_stale_tmp(os.path.join(self.notes_path, slugs[path_to_pdf]))
+
+    def restore(self, manifest):
+        'Add the entries of PDFs finished before the interruption to manifest'
+        for path_to_pdf, entry in self.finished.items():
+            manifest.update(path_to_pdf, entry)
+
+    def skip_done(self, pdfs, skipped, stats = None):
+        '''Drop PDFs the interrupted run already finished (or failed on) and
+        that haven't been modified since, and PDFs that were in progress at
+        MAX_ATTEMPTS interruptions; the latter are added to skipped as
+        (path_to_pdf, slugified_title, attempts). stats is an optional
+        {path: os.stat_result} of PDFs already stat'ed.
+        '''
+        for path_to_pdf, slugified_title in pdfs:
+            if path_to_pdf in self.finished:
+                entry = self.finished[path_to_pdf]
+                if entry is None:
+                    continue
+                stat = (stats or {}).get(path_to_pdf) or os.stat(path_to_pdf)
+                if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+                    continue
+            attempts = self.attempts.get(path_to_pdf, 0)
+            if attempts >= MAX_ATTEMPTS:
+                print(f"Skipping {path_to_pdf}: it was being processed when the last {attempts} runs stopped")
+                skipped.append((path_to_pdf, slugified_title, attempts))
+                continue
+            yield path_to_pdf, slugified_title
+
+    def open(self, resume = False):
+        # A resumed run adds to the journal so attempts keep counting; any
+        # other run starts a new one
+        self.file = open(self.path, "a" if resume else "w", encoding='utf-8')
+
+    def write(self, event):
+        self.file.write(json.dumps(event, separators=(',', ':')) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def started(self, path_to_pdf, slugified_title):
+        self.write({"event": "started", "pdf": path_to_pdf, "slug": slugified_title})
+
+    def done(self, path_to_pdf, ok, entry):
+        self.write({"event": "finished", "pdf": path_to_pdf, "ok": ok, "entry": entry})
+
+    def cancelled(self, path_to_pdf):
+        self.write({"event": "cancelled", "pdf": path_to_pdf})
+
+    def close(self, complete):
+        'Close the journal, removing it if the run got through every PDF'
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if complete and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = ".pdref-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, chunk_size = 1024*1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    '''Record of every source PDF seen by previous runs.
+
+    Entries are keyed by the absolute path of the source PDF and hold its
+    size, mtime, content hash, slug and a digest of its annotations. The
+    manifest lives in the notes folder so it travels with the notes.
+    '''
+
+    def __init__(self, notes_path):
+        self.path = os.path.join(notes_path, MANIFEST_NAME)
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            print("The manifest could not be read; all PDFs will be checked")
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.entries = data.get("pdfs", {})
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"version": MANIFEST_VERSION, "pdfs": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, path_to_pdf):
+        return self.entries.get(path_to_pdf)
+
+    def update(self, path_to_pdf, entry):
+        if entry:
+            self.entries[path_to_pdf] = entry
+
+    def is_current(self, path_to_pdf, stat, path_to_notes):
+        # Cheap check: same size and mtime as last time, and the notes are still there
+        entry = self.entries.get(path_to_pdf)
+        if not entry:
+            return False
+        if entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime:
+            return False
+        return os.path.exists(os.path.join(path_to_notes, "_index.md"))
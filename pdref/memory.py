@@ -0,0 +1,50 @@
+import gc
+import os
+import fitz
+
+# A PDF is handled in low-memory mode when its file size times this factor
+# would exceed the memory limit; decoded pages and images take several
+# times the space of the compressed file
+LOW_MEMORY_FACTOR = 4
+
+
+def current_rss_mb():
+    'Resident memory of this process in MB, or None where it can\'t be read cheaply'
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+class MemoryGuard:
+    '''Keeps processing under an optional memory ceiling (in MB).
+
+    With no limit it does nothing. With a limit, oversized PDFs are marked
+    low_memory: images are encoded on the calling thread instead of being
+    queued, and MuPDF's object cache is emptied after every page. Any PDF
+    whose process goes over the limit mid-document gets the same cleanup
+    from then on.
+    '''
+
+    def __init__(self, limit_mb = None, path_to_pdf = None):
+        self.limit_mb = limit_mb
+        self.low_memory = False
+        if limit_mb and path_to_pdf:
+            size_mb = os.path.getsize(path_to_pdf) / (1024 * 1024)
+            self.low_memory = size_mb * LOW_MEMORY_FACTOR > limit_mb
+
+    def image_threads(self, threads):
+        return 0 if self.low_memory else threads
+
+    def after_page(self):
+        if not self.limit_mb:
+            return
+        if not self.low_memory:
+            rss = current_rss_mb()
+            if rss is None or rss < self.limit_mb:
+                return
+            self.low_memory = True
+        fitz.TOOLS.store_shrink(100)
+        gc.collect(0)
@@ -1,290 +1,474 @@
-from operator import itemgetter
-from itertools import groupby
+import io
 import os
 from datetime import datetime
 import fitz
-from bisect import bisect_left, bisect_right
+import hashlib
+import struct
+from array import array
+from math import floor
 import text_utils
+from annotationdb import annotation_id, annotation_row
+from memory import MemoryGuard
+from pipeline import WriteBehind
+from runreport import PdfReport
+from images import ImageFilter, ImageWriter, image_extension, image_key, save_image
+from wordcache import page_key
 
 
-class SortedCollection(object):
-    '''Sequence sorted by a key function.
-
-    SortedCollection() is much easier to work with than using bisect() directly.
-    It supports key functions like those use in sorted(), min(), and max().
-    The result of the key function call is saved so that keys can be searched
-    efficiently.
-
-    Instead of returning an insertion-point which can be hard to interpret, the
-    five find-methods return a specific item in the sequence. They can scan for
-    exact matches, the last item less-than-or-equal to a key, or the first item
-    greater-than-or-equal to a key.
-
-    Once found, an item's ordinal position can be located with the index() method.
-    New items can be added with the insert() and insert_right() methods.
-    Old items can be deleted with the remove() method.
-
-    The usual sequence methods are provided to support indexing, slicing,
-    length lookup, clearing, copying, forward and reverse iteration, contains
-    checking, item counts, item removal, and a nice looking repr.
-
-    Finding and indexing are O(log n) operations while iteration and insertion
-    are O(n).  The initial sort is O(n log n).
-
-    The key function is stored in the 'key' attibute for easy introspection or
-    so that you can assign a new key function (triggering an automatic re-sort).
-
-    In short, the class was designed to handle all of the common use cases for
-    bisect but with a simpler API and support for key functions.
-
-    >>> from pprint import pprint
-    >>> from operator import itemgetter
-
-    >>> s = SortedCollection(key=itemgetter(2))
-    >>> for record in [
-    ...         ('roger', 'young', 30),
-    ...         ('angela', 'jones', 28),
-    ...         ('bill', 'smith', 22),
-    ...         ('david', 'thomas', 32)]:
-    ...     s.insert(record)
-
-    >>> pprint(list(s))         # show records sorted by age
-    [('bill', 'smith', 22),
-     ('angela', 'jones', 28),
-     ('roger', 'young', 30),
-     ('david', 'thomas', 32)]
-
-    >>> s.find_le(29)           # find oldest person aged 29 or younger
-    ('angela', 'jones', 28)
-    >>> s.find_lt(28)           # find oldest person under 28
-    ('bill', 'smith', 22)
-    >>> s.find_gt(28)           # find youngest person over 28
-    ('roger', 'young', 30)
-
-    >>> r = s.find_ge(32)       # find youngest person aged 32 or older
-    >>> s.index(r)              # get the index of their record
-    3
-    >>> s[3]                    # fetch the record at that index
-    ('david', 'thomas', 32)
-
-    >>> s.key = itemgetter(0)   # now sort by first name
-    >>> pprint(list(s))
-    [('angela', 'jones', 28),
-     ('bill', 'smith', 22),
-     ('david', 'thomas', 32),
-     ('roger', 'young', 30)]
+class WordTable(object):
+    '''Word geometry for one page, stored column-wise.
 
-    '''
-
-    def __init__(self, iterable=(), key=None):
-        self._given_key = key
-        key = (lambda x: x) if key is None else key
-        decorated = sorted((key(item), item) for item in iterable)
-        self._keys = [k for k, item in decorated]
-        self._items = [item for k, item in decorated]
-        self._key = key
-
-    def _getkey(self):
-        return self._key
-
-    def _setkey(self, key):
-        if key is not self._key:
-            self.__init__(self._items, key=key)
+    The output of page.get_text_words() is unpacked once into flat float
+    arrays plus a list of strings, so a page costs a handful of objects
+    instead of one tuple per word. Words are referred to by their row
+    index; WordIndex queries and make_text() both work on lists of indices.
 
-    def _delkey(self):
-        self._setkey(None)
-
-    key = property(_getkey, _setkey, _delkey, 'key function')
-
-    def clear(self):
-        self.__init__([], self._key)
+    The reading order (line by line, top to bottom, left to right within a
+    line) is ranked once per page, so ordering any subset of words is a
+    single sort keyed by that rank.
+    '''
 
-    def copy(self):
-        return self.__class__(self, self._key)
+    def __init__(self, words=()):
+        self.x0 = array('d')
+        self.y0 = array('d')
+        self.x1 = array('d')
+        self.y1 = array('d')
+        self.text = []
+        for w in words:
+            self.x0.append(w[0])
+            self.y0.append(w[1])
+            self.x1.append(w[2])
+            self.y1.append(w[3])
+            self.text.append(w[4])
+        self._rank = None
+
+    @classmethod
+    def from_page(cls, page):
+        return cls(page.get_text_words())
+
+    # Binary form, for the word cache: a header, the four coordinate
+    # columns as packed doubles, the byte length of each word and then
+    # the words themselves as one UTF-8 string table
+    HEADER = struct.Struct("<4sI")
+    MAGIC = b"PDW1"
+
+    def to_bytes(self):
+        text = [t.encode('utf-8') for t in self.text]
+        lengths = array('I', [len(t) for t in text])
+        return b"".join([
+            self.HEADER.pack(self.MAGIC, len(text)),
+            self.x0.tobytes(), self.y0.tobytes(), self.x1.tobytes(), self.y1.tobytes(),
+            lengths.tobytes(),
+        ] + text)
+
+    @classmethod
+    def from_bytes(cls, data):
+        'Returns None if data is not a valid table'
+        try:
+            magic, count = cls.HEADER.unpack_from(data)
+            if magic != cls.MAGIC:
+                return None
+            table = cls()
+            offset = cls.HEADER.size
+            for column in (table.x0, table.y0, table.x1, table.y1, array('I')):
+                end = offset + count * column.itemsize
+                column.frombytes(data[offset:end])
+                offset = end
+            lengths = column
+            if len(lengths) != count or offset + sum(lengths) != len(data):
+                return None
+            blob = data[offset:]
+            position = 0
+            for length in lengths:
+                table.text.append(blob[position:position + length].decode('utf-8'))
+                position += length
+            return table
+        except (struct.error, ValueError, UnicodeDecodeError):
+            return None
 
     def __len__(self):
-        return len(self._items)
+        return len(self.text)
 
     def __getitem__(self, i):
-        return self._items[i]
-
-    def __iter__(self):
-        return iter(self._items)
+        return (self.x0[i], self.y0[i], self.x1[i], self.y1[i], self.text[i])
+
+    def rank(self):
+        'Position of every word in reading order'
+        if self._rank is None:
+            # Words on the same line share the bottom coordinate rounded to
+            # 0.1: don't be too picky!
+            line = [round(y1, 1) for y1 in self.y1]
+            x0 = self.x0
+            order = sorted(range(len(self)), key=lambda i: (line[i], x0[i], i))
+            self._rank = array('l', bytes(array('l').itemsize * len(order)))
+            for position, i in enumerate(order):
+                self._rank[i] = position
+        return self._rank
+
+    def reading_order(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return sorted(indices, key=self.rank().__getitem__)
+
+    def make_text(self, indices=None):
+        text = self.text
+        return " ".join([text[i] for i in self.reading_order(indices)])
+
+
+class WordIndex(object):
+    '''Words on a page bucketed into horizontal bands by their y extent.
+
+    Built once per page and shared by every annotation on it. A query only
+    tests the words in the bands the rectangle overlaps, instead of every
+    word on the page, and compares plain floats instead of building a
+    fitz.Rect per word.
+
+    intersecting() returns the indices of the same words, in the same
+    order, as [w for w in words if fitz.Rect(w[:4]).intersects(rect)].
+    '''
 
-    def __reversed__(self):
-        return reversed(self._items)
+    def __init__(self, table, band_height=None):
+        if not isinstance(table, WordTable):
+            table = WordTable(table)
+        self.table = table
+        if band_height is None:
+            heights = [y1 - y0 for y0, y1 in zip(table.y0, table.y1) if y1 > y0]
+            band_height = sum(heights) / len(heights) if heights else 1.0
+        self.band_height = max(band_height, 1.0)
+
+        self.bands = {}
+        for i, (x0, y0, x1, y1) in enumerate(zip(table.x0, table.y0, table.x1, table.y1)):
+            if x0 >= x1 or y0 >= y1:
+                continue  # empty boxes never intersect anything
+            for band in range(self._band(y0), self._band(y1) + 1):
+                self.bands.setdefault(band, []).append(i)
+        self.first_band = min(self.bands) if self.bands else 0
+        self.last_band = max(self.bands) if self.bands else -1
+
+    def _band(self, y):
+        return floor(y / self.band_height)
 
-    def __repr__(self):
-        return '%s(%r, key=%s)' % (
-            self.__class__.__name__,
-            self._items,
-            getattr(self._given_key, '__name__', repr(self._given_key))
-        )
+    def __len__(self):
+        return len(self.table)
+
+    def intersecting(self, rect):
+        'Return the indices of the words whose boxes overlap rect, in page order'
+        x0, y0, x1, y1 = rect
+        if x0 >= x1 or y0 >= y1:
+            return []
+        first = max(self._band(y0), self.first_band)
+        last = min(self._band(y1), self.last_band)
+        wx0, wy0, wx1, wy1 = self.table.x0, self.table.y0, self.table.x1, self.table.y1
+        hits = set()
+        for band in range(first, last + 1):
+            for i in self.bands.get(band, ()):
+                if i in hits:
+                    continue
+                if max(wx0[i], x0) < min(wx1[i], x1) and max(wy0[i], y0) < min(wy1[i], y1):
+                    hits.add(i)
+        return sorted(hits)
+
+
+def load_words(page, word_cache = None, report = None):
+    'Return the WordTable for page, from word_cache (a wordcache.WordCache) when it has it'
+    if word_cache is None:
+        return WordTable.from_page(page)
+    key = page_key(page, word_cache.digests(page.parent))
+    data = word_cache.get(key)
+    table = WordTable.from_bytes(data) if data is not None else None
+    if table is not None:
+        if report is not None:
+            report.count("word_cache_hits")
+        return table
+    table = WordTable.from_page(page)
+    word_cache.put(key, table.to_bytes())
+    if report is not None:
+        report.count("word_cache_misses")
+    return table
 
-    def __reduce__(self):
-        return self.__class__, (self._items, self._given_key)
-
-    def __contains__(self, item):
-        k = self._key(item)
-        i = bisect_left(self._keys, k)
-        j = bisect_right(self._keys, k)
-        return item in self._items[i:j]
-
-    def index(self, item):
-        'Find the position of an item.  Raise ValueError if not found.'
-        k = self._key(item)
-        i = bisect_left(self._keys, k)
-        j = bisect_right(self._keys, k)
-        return self._items[i:j].index(item) + i
-
-    def count(self, item):
-        'Return number of occurrences of item'
-        k = self._key(item)
-        i = bisect_left(self._keys, k)
-        j = bisect_right(self._keys, k)
-        return self._items[i:j].count(item)
-
-    def insert(self, item):
-        'Insert a new item.  If equal keys are found, add to the left'
-        k = self._key(item)
-        i = bisect_left(self._keys, k)
-        self._keys.insert(i, k)
-        self._items.insert(i, item)
-
-    def insert_right(self, item):
-        'Insert a new item.  If equal keys are found, add to the right'
-        k = self._key(item)
-        i = bisect_right(self._keys, k)
-        self._keys.insert(i, k)
-        self._items.insert(i, item)
-
-    def remove(self, item):
-        'Remove first occurence of item.  Raise ValueError if not found'
-        i = self.index(item)
-        del self._keys[i]
-        del self._items[i]
-
-    def find(self, k):
-        'Return first item with a key == k.  Raise ValueError if not found.'
-        i = bisect_left(self._keys, k)
-        if i != len(self) and self._keys[i] == k:
-            return self._items[i]
-        raise ValueError('No item found with key equal to: %r' % (k,))
-
-    def find_le(self, k):
-        'Return last item with a key <= k.  Raise ValueError if not found.'
-        i = bisect_right(self._keys, k)
-        if i:
-            return self._items[i-1]
-        raise ValueError('No item found with key at or below: %r' % (k,))
-
-    def find_lt(self, k):
-        'Return last item with a key < k.  Raise ValueError if not found.'
-        i = bisect_left(self._keys, k)
-        if i:
-            return self._items[i-1]
-        raise ValueError('No item found with key below: %r' % (k,))
-
-    def find_ge(self, k):
-        'Return first item with a key >= equal to k.  Raise ValueError if not found'
-        i = bisect_left(self._keys, k)
-        if i != len(self):
-            return self._items[i]
-        raise ValueError('No item found with key at or above: %r' % (k,))
-
-    def find_gt(self, k):
-        'Return first item with a key > k.  Raise ValueError if not found'
-        i = bisect_right(self._keys, k)
-        if i != len(self):
-            return self._items[i]
-        raise ValueError('No item found with key above: %r' % (k,))
 
 def make_text(words):
     """Return textstring output of getText("words").
     Word items are sorted for reading sequence left to right,
     top to bottom.
     """
-    line_dict = {}  # key: vertical coordinate, value: list of words
-    words.sort(key=lambda w: w[0])  # sort by horizontal coordinate
-    for w in words:  # fill the line dictionary
-        y1 = round(w[3], 1)  # bottom of a word: don't be too picky!
-        word = w[4]  # the text of the word
-        line = line_dict.get(y1, [])  # read current line content
-        line.append(word)  # append new word
-        line_dict[y1] = line  # write back to dict
-    lines = list(line_dict.items())
-    lines.sort()  # sort vertically
-    return " ".join([" ".join(line[1]) for line in lines])
-
-
-def process_pdf(path_to_pdf, path_to_pdf_copy, path_to_notes, image_size = None, debug = False):
-    doc = fitz.open(path_to_pdf)
-    # if not image_size:
-    #     image_size = 500*500
+    return WordTable(words).make_text()
 
-    # Check whether this ref has been processed previously
-    time = datetime.now().strftime("%Y%m%d-%H%M%S")
-    notes_name_formatted = f"_index.md"
-    branch_index_path = os.path.join(path_to_notes, notes_name_formatted)
-
-    if not os.path.exists(branch_index_path):
-        metadata_title = doc.metadata['title'][0:20]
 
-        file = os.path.basename(path_to_pdf_copy)
-        ext = os.path.splitext(file)
-        pdf_slug = text_utils.slugify(ext[0])
+def annotation_digest(doc, slug = None, record = None, counts = None):
+    """Return a hash of every annotation in the document.
+    Two runs with the same digest would write the same notes.
+    Each annotation is also added to record (a delta.AnnotationRecord), if given,
+    and counted in counts["annotations"] (e.g. a Counter), if given.
+    """
+    h = hashlib.sha256()
+    for index in range(doc.page_count):
+        page = doc[index]
+        annot = page.first_annot
+        while annot:
+            info = annot.info
+            h.update(repr((index, annot.type[0], tuple(annot.rect), info['content'], info.get('modDate', ''))).encode('utf-8'))
+            if record is not None:
+                record.add(annotation_id(slug, index + 1, annot), index + 1, annot)
+            if counts is not None:
+                counts["annotations"] += 1
+            annot = annot.next
+    return h.hexdigest()
+
+
+def write_index_pages(doc, f, pages, pdf_slug, path_to_notes, debug, image_store, image_writer, image_filter, report, memory_guard, saved_images):
+    """Write the images of each page in pages (1-based page numbers) to f.
+    saved_images maps each xref seen so far to its file, or None if left out.
+    """
+    for index in pages:
+        images = doc.get_page_images(index-1)
+        report.count("images", len(images))
+        page = None
+        if images:
+            # Indicate page number
+            f.write("\n## Page {}\n".format(index))
+
+        # Save and reference images
+        for img in images:
+            try:
+                xref = img[0]
+                if xref in saved_images and saved_images[xref] is None:
+                    continue
+
+                # Size and placement filters only look at metadata, before any decode
+                reason = image_filter.intrinsic_reason(img)
+                if reason:
+                    saved_images[xref] = None
+                else:
+                    if page is None and (image_filter.margin or image_filter.min_rendered):
+                        page = doc[index-1]
+                    reason = image_filter.placement_reason(page, img)
+                if reason:
+                    image_filter.count(reason)
+                    continue
+
+                if xref in saved_images:
+                    # Shared image (e.g. a logo on every page): reference the first copy
+                    markdown_reference = saved_images[xref]
+                    f.writelines(["\n", "[![](", markdown_reference, ")](",markdown_reference,")" "\n"])
+                    continue
+
+                if image_store is not None:
+                    key = image_key(doc, img)
+                    if image_store.is_excluded(key):
+                        saved_images[xref] = None
+                        continue
+
+                if debug:
+                    pix = fitz.Pixmap(doc, xref)
+                    f.writelines(text_utils.debug_image_text(pix))
+                    pix = None
+                ext = image_extension(doc, img)
+                image_name = f"{pdf_slug}-p{index:03d}-{xref}.{ext}"
+                image_path = os.path.join(path_to_notes, image_name)
+                markdown_reference = "/".join([image_name])
+                with report.stage("image_save"):
+                    if image_store is not None:
+                        markdown_reference = image_store.save(doc, img, ext, key, image_path, image_writer)
+                    elif not save_image(doc, img, ext, image_path, image_writer):
+                        markdown_reference = None
+                if markdown_reference is None:
+                    saved_images[xref] = None
+                    continue
+                saved_images[xref] = markdown_reference
+                report.count("images_saved")
+                f.writelines(["\n", "[![](", markdown_reference, ")](",markdown_reference,")" "\n"])
+            except Exception as e:
+                report.error(f"image p{index} xref {img[0]}", e)
+
+        page = None
+        memory_guard.after_page()
+
+
+def write_index(doc, branch_index_path, path_to_pdf_copy, path_to_notes, debug = False, image_store = None, image_threads = 2, image_filter = None, report = None, memory_guard = None, parts = None, writes = None):
+    """Write _index.md: metadata frontmatter, a link to the PDF copy and
+    every image, page by page. parts, if given, holds the pages already
+    written by shard workers (see shard.py). The file is built in memory
+    and written in one go through writes (a pipeline.WriteBehind).
+    """
+    if writes is None:
+        writes = WriteBehind()
+    if image_filter is None:
+        image_filter = ImageFilter()
+    if report is None:
+        report = PdfReport()
+    if memory_guard is None:
+        memory_guard = MemoryGuard()
+
+    metadata_title = doc.metadata['title'][0:20]
+
+    file = os.path.basename(path_to_pdf_copy)
+    ext = os.path.splitext(file)
+    pdf_slug = text_utils.slugify(ext[0])
+
+    if not metadata_title:
+        notes_name_title = pdf_slug
+    else:
+        notes_name_title = text_utils.slugify(metadata_title)
+
+    with io.StringIO() as f:
+        title = doc.metadata['title']
+        notes_frontmatter = text_utils.make_frontmatter(
+            title = title if title else notes_name_title,
+            author=doc.metadata['author'],
+            keys=doc.metadata['keywords'].split(','),
+            top_level = "true"
+        )
+        f.writelines(notes_frontmatter)
+        f.writelines(f"\n\n[PDF]({os.path.basename(path_to_pdf_copy)})\n")
 
-        if not metadata_title:
-            notes_name_title = pdf_slug
+        if parts is not None:
+            # Pages already written by shard workers
+            f.write(parts.index_text)
+            image_bytes = parts.image_bytes
         else:
-            notes_name_title = text_utils.slugify(metadata_title)
+            # Images already referenced in this document, by xref (None if left out)
+            image_writer = ImageWriter(memory_guard.image_threads(image_threads))
+            saved_images = {}
+            write_index_pages(doc, f, range(1, doc.page_count + 1), pdf_slug, path_to_notes, debug, image_store, image_writer, image_filter, report, memory_guard, saved_images)
 
-        with open(branch_index_path, "w", encoding='utf-8') as f:
-            title = doc.metadata['title']
-            notes_frontmatter = text_utils.make_frontmatter(
-                title = title if title else notes_name_title,
-                author=doc.metadata['author'],
-                keys=doc.metadata['keywords'].split(','),
-                top_level = "true"
-            )
-            f.writelines(notes_frontmatter)
-            f.writelines(f"\n\n[PDF]({os.path.basename(path_to_pdf_copy)})\n")
-
-            pages = [ doc[ i ] for i in range( doc.page_count ) ]
-
-            for index, page in enumerate(pages, start=1):
-                images = doc.get_page_images(index-1)
-                if images:
-                    # Indicate page number
-                    f.write("\n## Page {}\n".format(index))
-
-                # Save and reference images
-                for img in images:
-                    try:
-                        xref = img[0]
-                        pix = fitz.Pixmap(doc, xref)
-                        if debug:
-                            f.writelines(text_utils.debug_image_text(pix))
-                        # if (pix.size < image_size):
-                        #     # The image is too small to be considered a figure
-                        #     f.writelines(["\n", "**Skip**", "\n"])
-                        #     # continue
-
-                        image_name = f"{pdf_slug}-p{index:03d}-{xref}.png"
-                        image_path = os.path.join(path_to_notes, image_name)
-                        markdown_reference = "/".join([image_name])
-                        if pix.colorspace.name in [fitz.csRGB.name, fitz.csGRAY.name]:       # this is GRAY or RGB
-                            pix.save(image_path)
-                        elif pix.colorspace.name in [fitz.csCMYK.name]:               # CMYK: convert to RGB first
-                            pix1 = fitz.Pixmap(fitz.csRGB, pix)
-                            pix1.save(image_path)
-                            pix1 = None
-                        pix = None
-                        f.writelines(["\n", "[![](", markdown_reference, ")](",markdown_reference,")" "\n"])
-                    except:
-                        # print(f"There was a problem saving an image")
-                        pass
+            with report.stage("image_wait"):
+                for e in image_writer.close():
+                    report.error("image write", e)
+            image_bytes = image_writer.bytes_written
+        report.count("image_bytes", image_bytes)
+        index_bytes = writes.write(branch_index_path, f.getvalue())
 
+    report.count("bytes_written", index_bytes + image_bytes)
+
+
+def collect_annotation_rows(doc, pdf_slug, word_cache = None, report = None, snapshots = None):
+    """Return the annotationdb rows write_notes_pages would collect for doc,
+    without writing any notes. Used to fill the database for PDFs whose
+    notes are already up to date.
+    """
+    rows = []
+    for index in range(1, doc.page_count + 1):
+        page = doc[index-1]
+        annot = page.first_annot
+        word_index = None
+        while annot:
+            annot_type = annot.type[0]
+            if annot_type in (0, 2) or (snapshots is not None and snapshots.wanted(annot)):
+                rows.append(annotation_row(pdf_slug, index, annot))
+            elif annot_type in (8, 9, 10, 11):
+                if word_index is None:
+                    word_index = WordIndex(load_words(page, word_cache, report))
+                quote = word_index.table.make_text(word_index.intersecting(annot.rect))
+                rows.append(annotation_row(pdf_slug, index, annot, quote))
+            annot = annot.next
+        word_index = page = None
+    return rows
+
+
+def write_notes_pages(doc, f, pages, pdf_slug, stats, annotation_rows, report, memory_guard, delta = None, word_cache = None, snapshots = None):
+    """Write the annotations of each page in pages (1-based page numbers) to f.
+    With snapshots (a snapshots.Snapshots), ink and shape annotations are
+    shown as pictures of the area they cover.
+    """
+    # Only pages with annotations are visited further, and words are only
+    # extracted once a page turns out to have a highlight-type annotation
+    for index in pages:
+        page = doc[index-1]
+
+        # Get annotations
+        annot = page.first_annot
+
+        # Skip if there are no anntations
+        if not annot:
+            stats["pages_skipped"] += 1
+            report.count("pages_skipped")
+            memory_guard.after_page()
+            continue
+
+        # Page number, written before the first annotation on the page
+        page_heading = "\n## Page {}\n".format(index)
+        word_index = None
+
+        while annot:                
+            label = ""
+            if delta is not None:
+                change = delta[0].get(annotation_id(pdf_slug, index, annot))
+                if change is None:
+                    report.count("annotations_unchanged")
+                    annot = annot.next
+                    continue
+                label = "(edited) " if change == "changed" else ""
+            if page_heading:
+                f.write(page_heading)
+                page_heading = None
+
+            # Text annotation (comment), Free text
+            if annot.type[0] in (0, 2):
+                text = "\n- %s%s" % (label, annot.info['content'])
+                f.write(text)
+                if annotation_rows is not None:
+                    annotation_rows.append(annotation_row(pdf_slug, index, annot))
+
+            # Highlight, Underline, Strikethrough, etc
+            f.write("\n")
+            if annot.type[0] in (8, 9, 10, 11): # one of the 4 types above
+                if (annot.info['content'] == ''):
+                    text = "\n- %s%s" % (label, "Highlighted text: ")
+                    f.write(text)
+                else:
+                    text = "\n- %s%s" % (label, annot.info['content'])
+                    f.write(text)
+                rect = annot.rect # this is the rectangle the annot covers
+                if word_index is None:
+                    with report.stage("words"):
+                        table = load_words(page, word_cache, report)
+                    report.count("words", len(table))
+                    with report.stage("matching"):
+                        word_index = WordIndex(table)
+
+                # Intersecting bounds - full word
+                with report.stage("matching"):
+                    mywords = word_index.intersecting(rect)
+                    quote = word_index.table.make_text(mywords)
+                if annotation_rows is not None:
+                    annotation_rows.append(annotation_row(pdf_slug, index, annot, quote))
+                f.writelines(["\n\n    > ", quote, "\n"])
+
+            # Ink, Square, Circle, Polygon, etc
+            if snapshots is not None and snapshots.wanted(annot):
+                reference = snapshots.reference(page, index, annot, report)
+                if reference is not None:
+                    text = "\n- %s%s" % (label, annot.info['content'] or annot.type[1])
+                    f.write(text)
+                    f.writelines(["\n\n    ![](", reference, ")\n"])
+                    if annotation_rows is not None:
+                        annotation_rows.append(annotation_row(pdf_slug, index, annot))
+
+            report.count("annotations")
+            annot = annot.next # None returned after last annot
+
+        # Let go of the page and its words before the next one is loaded
+        word_index = table = page = None
+        memory_guard.after_page()
+
+
+def write_notes(doc, path_to_notes, path_to_pdf_copy, time, stats, collect_annotations = False, report = None, memory_guard = None, delta = None, parts = None, word_cache = None, writes = None, snapshots = None):
+    """Write notes/<time>.md with every comment and highlight, page by page.
+
+    Only one page, and at most one page's words, is held at a time.
+    With delta, the (changed, removed) pair from AnnotationRecord.delta(),
+    only added and changed annotations are written, followed by a list of
+    the removed ones. parts, if given, holds the pages already written by
+    shard workers (see shard.py). Like _index.md, the file is written in
+    one go through writes. snapshots is passed on to write_notes_pages.
+    """
+    if writes is None:
+        writes = WriteBehind()
+    if report is None:
+        report = PdfReport()
+    if memory_guard is None:
+        memory_guard = MemoryGuard()
     # Check for notes directory
     path_to_notes_dir = os.path.join(path_to_notes, "notes")
     if (not os.path.exists(path_to_notes_dir)):
@@ -292,7 +476,7 @@ def process_pdf(path_to_pdf, path_to_pdf_copy, path_to_notes, image_size = None,
 
     notes_path = os.path.join(path_to_notes_dir, f"{time}.md")
 
-    with open(notes_path, "a", encoding='utf-8') as f:
+    with io.StringIO() as f:
         metadata_title = doc.metadata['title'][0:20]
 
         if not metadata_title:
@@ -307,65 +491,83 @@ def process_pdf(path_to_pdf, path_to_pdf_copy, path_to_notes, image_size = None,
             author = doc.metadata['author']
         )
         f.writelines(notes_frontmatter)
-        
 
-    with open(notes_path, "a", encoding='utf-8') as f:
         f.writelines(["\n\n", "# ", datetime.now().strftime("%Y%m%d %H:%M:%S"), "\n\n"])
 
-        pages = [ doc[ i ] for i in range( doc.page_count ) ]
+        # Rows for the annotation database, when one is in use
+        annotation_rows = [] if collect_annotations else None
+        pdf_slug = text_utils.slugify(os.path.splitext(os.path.basename(path_to_pdf_copy))[0])
 
-        for index, page in enumerate(pages, start=1):
+        if parts is not None:
+            # Pages already written by shard workers
+            f.write(parts.notes_text)
+            if annotation_rows is not None:
+                annotation_rows.extend(parts.annotation_rows)
+        else:
+            write_notes_pages(doc, f, range(1, doc.page_count + 1), pdf_slug, stats, annotation_rows, report, memory_guard, delta, word_cache, snapshots)
 
-            text_words = page.get_text_words()
-        #   print(text_words)
+        if delta is not None and delta[1]:
+            f.write("\n## Removed\n")
+            for id, page_number, preview in delta[1]:
+                f.write("\n- Page {}: {}".format(page_number, preview or "(no comment)"))
+            f.write("\n")
 
-            # The words should be ordered by y1 and x0
-            sorted_words = SortedCollection( key = itemgetter( 3, 0 ) )
+        f.writelines(["\n\n", "---"])
+        notes_bytes = writes.write(notes_path, f.getvalue(), "a")
 
-            for word in text_words:
-                sorted_words.insert( word )
+    if annotation_rows is not None:
+        stats["annotations"] = annotation_rows
+        if delta is not None:
+            stats["annotations_removed"] = [id for id, page_number, preview in delta[1]]
+    report.count("bytes_written", notes_bytes)
 
-            # At this point you already have an ordered list. If you need to 
-            # group the content by lines, use groupby with y1 as a key
-            lines = groupby( sorted_words, key = itemgetter( 3 ) )
 
-            # Get annotations
-            annot = page.first_annot
+def process_pdf(path_to_pdf, path_to_pdf_copy, path_to_notes, image_size = None, debug = False, doc = None, image_store = None, image_threads = 2, image_filter = None, collect_annotations = False, report = None, memory_guard = None, delta = None, shard_workers = 1, shard_min_pages = None, word_cache = None, writes = None, snapshots = None, shard_executor = None):
+    """Write _index.md (first time only) and a new notes file for one PDF.
 
-            # Skip if there are no anntations
-            if not annot:
-                continue
-            else:
-                # Indicate page number
-                f.write("\n## Page {}\n".format(index))
-                
+    A doc passed in stays open and is the caller's to close; one opened
+    here is closed before returning. A PDF with at least shard_min_pages
+    pages is split into page ranges written by shard_workers processes,
+    on shard_executor when given. Never shard from inside a pool worker.
+    The files are written through writes, which may finish after returning.
+    """
+    if report is None:
+        report = PdfReport(path_to_pdf)
+    if doc is None:
+        with report.stage("open"):
+            doc = fitz.open(path_to_pdf)
+        with doc:
+            return process_pdf(path_to_pdf, path_to_pdf_copy, path_to_notes, image_size, debug, doc, image_store, image_threads, image_filter, collect_annotations, report, memory_guard, delta, shard_workers, shard_min_pages, word_cache, writes, snapshots, shard_executor)
+    if memory_guard is None:
+        memory_guard = MemoryGuard()
+    report.count("pages", doc.page_count)
+    if image_filter is None:
+        image_filter = ImageFilter(min_area = image_size)
+    stats = {"pages_skipped": 0, "images_filtered": image_filter.counts}
 
-            while annot:                
-                # Text annotation (comment), Free text
-                if annot.type[0] in (0, 2):
-                    text = "\n- %s" % (annot.info['content'])
-                    f.write(text)
+    # Check whether this ref has been processed previously
+    time = datetime.now().strftime("%Y%m%d-%H%M%S")
+    notes_name_formatted = f"_index.md"
+    branch_index_path = os.path.join(path_to_notes, notes_name_formatted)
+
+    write_images = not os.path.exists(branch_index_path)
+
+    parts = None
+    if shard_workers > 1 and shard_min_pages and doc.page_count >= shard_min_pages and not debug:
+        from shard import run_shards
+        pdf_slug = text_utils.slugify(os.path.splitext(os.path.basename(path_to_pdf_copy))[0])
+        print(f"    Splitting {doc.page_count} pages across {shard_workers} processes")
+        with report.stage("shards"):
+            parts = run_shards(path_to_pdf, doc.page_count, shard_workers, pdf_slug, path_to_notes, write_images, image_store, image_threads, image_filter, collect_annotations, memory_guard, delta, word_cache, snapshots, report, shard_executor)
+        stats["pages_skipped"] += parts.pages_skipped
+
+    if write_images:
+        with report.stage("images"):
+            write_index(doc, branch_index_path, path_to_pdf_copy, path_to_notes, debug, image_store, image_threads, image_filter, report, memory_guard, parts, writes)
+
+    with report.stage("notes"):
+        write_notes(doc, path_to_notes, path_to_pdf_copy, time, stats, collect_annotations, report, memory_guard, delta, parts, word_cache, writes, snapshots)
+    report.counts.update({f"images_filtered_{reason}": n for reason, n in image_filter.counts.items()})
 
-                # Highlight, Underline, Strikethrough, etc
-                f.write("\n")
-                if annot.type[0] in (8, 9, 10, 11): # one of the 4 types above
-                    if (annot.info['content'] == ''):
-                        text = "\n- %s" % ("Highlighted text: ")
-                        f.write(text)
-                    else:
-                        text = "\n- %s" % (annot.info['content'])
-                        f.write(text)
-                    rect = annot.rect # this is the rectangle the annot covers
-
-                    # Intersecting bounds - full word
-                    mywords = [w for w in text_words if fitz.Rect(w[:4]).intersects(rect)]
-                    try:
-                        f.write("\n\n    > ")
-                        f.write(make_text(mywords))
-                        f.write("\n")
-                    except UnicodeEncodeError:
-                        print("Error writing annotation")
-
-                annot = annot.next # None returned after last annot
-
-        f.writelines(["\n\n", "---"])
\ No newline at end of file
+    print(f"    Skipped {stats['pages_skipped']} of {doc.page_count} pages without annotations")
+    return stats
@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+from collections import deque
+from images import write_file
+from ingest import Source
+from memory import MemoryGuard
+
+# Stands in for the end of a threaded() iterable
+_DONE = object()
+
+
+def write_bytes(path, data, mode = "w"):
+    '''Replace path with data, or with its old content and data for mode "a".
+    Either way the new file is renamed into place, so an interrupted run
+    never leaves one half written.
+    '''
+    written = len(data)
+    if mode == "a" and os.path.exists(path):
+        with open(path, "rb") as f:
+            data = f.read() + data
+    write_file(path, data)
+    return written
+
+
+class WriteBehind:
+    '''File writes for one PDF, done on an I/O thread pool.
+
+    With no pool everything happens immediately, in order. With a pool,
+    write() and call() return straight away and wait() blocks until they
+    are done, raising the first error; functions passed to then() run
+    after that, on the waiting thread (e.g. recording that the notes are
+    complete only once they're on disk).
+    '''
+
+    def __init__(self, pool = None):
+        self.pool = pool
+        self.futures = []
+        self.after = []
+
+    def call(self, fn, *args):
+        if self.pool is None:
+            fn(*args)
+        else:
+            self.futures.append(self.pool.submit(fn, *args))
+
+    def write(self, path, text, mode = "w"):
+        'Write text as UTF-8 in one go; returns the number of bytes'
+        data = text.encode('utf-8', 'replace')
+        self.call(write_bytes, path, data, mode)
+        return len(data)
+
+    def then(self, fn, *args):
+        if self.pool is None:
+            fn(*args)
+        else:
+            self.after.append((fn, args))
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        for fn, args in self.after:
+            fn(*args)
+        self.futures, self.after = [], []
+
+
+class PendingPdf:
+    '''A processed PDF whose files may still be being written.
+
+    result() waits for the writes and returns (ok, manifest entry,
+    process_pdf counts, report as a dict); a failed write turns it into a
+    failed PDF, so the manifest never records notes that aren't on disk.
+    '''
+
+    def __init__(self, writes, ok, entry, stats, report):
+        self.writes = writes
+        self.ok = ok
+        self.entry = entry
+        self.stats = stats
+        self.report = report
+
+    def done(self):
+        return self.writes.done()
+
+    def result(self):
+        try:
+            with self.report.stage("write_wait"):
+                self.writes.wait()
+        except Exception as e:
+            print(f"There was a problem writing the notes for {self.report.path}: {e}")
+            self.report.status = "failed"
+            self.report.error("write", e)
+            self.ok, self.entry, self.stats = False, None, None
+        return self.ok, self.entry, self.stats, self.report.as_dict()
+
+
+def read_source(path_to_pdf, memory_limit_mb = None):
+    return Source(path_to_pdf, keep_bytes = not MemoryGuard(memory_limit_mb, path_to_pdf).low_memory)
+
+
+def prefetch_sources(pdfs, pool, depth, memory_limit_mb = None):
+    '''Yield (path_to_pdf, slugified_title, future Source), reading up to
+    depth PDFs ahead on pool while the caller works on the current one.
+    Closing the generator cancels the reads not started yet.
+    '''
+    ahead = deque()
+    try:
+        for path_to_pdf, slugified_title in pdfs:
+            ahead.append((path_to_pdf, slugified_title, pool.submit(read_source, path_to_pdf, memory_limit_mb)))
+            if len(ahead) > depth:
+                yield ahead.popleft()
+        while ahead:
+            yield ahead.popleft()
+    finally:
+        for path_to_pdf, slugified_title, future in ahead:
+            future.cancel()
+
+
+def threaded(iterable, maxsize):
+    '''Run iterable on its own thread, at most maxsize items ahead of the
+    consumer. Used to keep discovery going while PDFs are processed.
+    '''
+    items = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
@@ -0,0 +1,128 @@
+import cProfile
+import csv
+import json
+import os
+from collections import Counter
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from time import perf_counter
+
+REPORTS_NAME = ".pdref-reports"
+
+
+class PdfReport:
+    '''Timings, counts and errors for one PDF.
+
+    Stage timings accumulate, so a stage entered once per page adds up
+    to the time for the whole document. Errors that are otherwise
+    swallowed (e.g. an image that can't be saved) are kept here.
+    '''
+
+    def __init__(self, path_to_pdf = '', slug = ''):
+        self.path = path_to_pdf
+        self.slug = slug
+        self.status = "processed"
+        self.timings = {}
+        self.counts = Counter()
+        self.errors = []
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + perf_counter() - start
+
+    def count(self, name, n = 1):
+        self.counts[name] += n
+
+    def error(self, stage, exception):
+        self.errors.append(f"{stage}: {type(exception).__name__}: {exception}")
+
+    def as_dict(self):
+        return {
+            "path": self.path,
+            "slug": self.slug,
+            "status": self.status,
+            "seconds": round(self.timings.get("total", 0.0), 6),
+            "timings": {name: round(t, 6) for name, t in self.timings.items()},
+            "counts": dict(self.counts),
+            "errors": self.errors,
+        }
+
+
+def reports_path(notes_path):
+    path = os.path.join(notes_path, REPORTS_NAME)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def should_profile(path_to_pdf, patterns):
+    'patterns is a list of filename globs, e.g. ["*"] or ["*manual*.pdf"]'
+    name = os.path.basename(path_to_pdf)
+    return any(fnmatch(name, pattern) or fnmatch(path_to_pdf, pattern) for pattern in patterns or ())
+
+
+@contextmanager
+def maybe_profile(path_to_pdf, slug, preferences):
+    # cProfile one PDF into <notes>/.pdref-reports/<slug>.prof, for snakeviz/pstats
+    if not should_profile(path_to_pdf, preferences.profile_pdfs):
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(reports_path(preferences.notes_path), f"{slug}.prof"))
+
+
+def prune_run_reports(folder, keep):
+    'Remove all but the newest keep run reports in folder'
+    # The timestamp in the name sorts in run order
+    runs = sorted(name for name in os.listdir(folder) if name.startswith("run-") and name.endswith((".json", ".csv")))
+    for name in runs[:max(len(runs) - keep, 0)]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+
+
+def write_run_report(notes_path, reports, started, report_format = "json", keep = None):
+    '''Write the per-PDF reports for one run; returns the file written.
+    With keep, only the newest keep run reports are left in the folder.
+    '''
+    path = os.path.join(reports_path(notes_path), f"run-{started}.{report_format}")
+    tmp_path = path + ".tmp"
+    if report_format == "csv":
+        stages = sorted({name for r in reports for name in r["timings"]})
+        counts = sorted({name for r in reports for name in r["counts"]})
+        with open(tmp_path, "w", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["path", "slug", "status", "seconds"] + [f"{s}_seconds" for s in stages] + counts + ["errors"])
+            for r in reports:
+                writer.writerow(
+                    [r["path"], r["slug"], r["status"], r["seconds"]]
+                    + [r["timings"].get(s, 0) for s in stages]
+                    + [r["counts"].get(c, 0) for c in counts]
+                    + ["; ".join(r["errors"])]
+                )
+    else:
+        totals = Counter()
+        for r in reports:
+            totals.update(r["timings"])
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({
+                "started": started,
+                "pdfs": len(reports),
+                "seconds_by_stage": {name: round(t, 6) for name, t in totals.items()},
+                "slowest": [r["path"] for r in sorted(reports, key=lambda r: r["seconds"], reverse=True)[:10]],
+                "reports": reports,
+            }, f, indent=1)
+    os.replace(tmp_path, path)
+    if keep:
+        prune_run_reports(os.path.dirname(path), keep)
+    return path
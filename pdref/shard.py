@@ -0,0 +1,136 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+from images import ImageWriter
+from memory import MemoryGuard
+from parse import write_index_pages, write_notes_pages
+from runreport import PdfReport
+
+# Each worker gets several page ranges, so one slow range (e.g. all the
+# scanned plates of a manual) doesn't hold up the others
+RANGES_PER_WORKER = 4
+MIN_RANGE_PAGES = 50
+
+
+def page_ranges(page_count, workers):
+    'Split pages 1..page_count into consecutive ranges'
+    count = max(1, min(workers * RANGES_PER_WORKER, page_count // MIN_RANGE_PAGES))
+    size = -(-page_count // count)
+    return [range(start, min(start + size, page_count + 1)) for start in range(1, page_count + 1, size)]
+
+
+class Parts:
+    '''The pages of one PDF written by shard workers, merged in page order.
+
+    index_text and notes_text go where write_index and write_notes would
+    have written their pages, so the files match a serial run.
+    '''
+
+    def __init__(self):
+        self.index_text = ""
+        self.notes_text = ""
+        self.image_bytes = 0
+        self.pages_skipped = 0
+        self.annotation_rows = []
+
+
+def _shard_worker(path_to_pdf, pages, pdf_slug, path_to_notes, write_images, options):
+    # Runs in a pool process: opens the PDF itself and writes one page range
+    report = PdfReport()
+    image_filter = options["image_filter"]
+    memory_guard = MemoryGuard(options["memory_limit_mb"], path_to_pdf)
+    result = {"index": None, "saved": {}, "image_bytes": 0}
+    with fitz.open(path_to_pdf) as doc:
+        if write_images:
+            f = io.StringIO()
+            image_writer = ImageWriter(memory_guard.image_threads(options["image_threads"]))
+            write_index_pages(doc, f, pages, pdf_slug, path_to_notes, False, options["image_store"], image_writer, image_filter, report, memory_guard, result["saved"])
+            with report.stage("image_wait"):
+                for e in image_writer.close():
+                    report.error("image write", e)
+            result["index"] = f.getvalue()
+            result["image_bytes"] = image_writer.bytes_written
+
+        f = io.StringIO()
+        stats = {"pages_skipped": 0}
+        rows = [] if options["collect_annotations"] else None
+        write_notes_pages(doc, f, pages, pdf_slug, stats, rows, report, memory_guard, options["delta"], options["word_cache"], options["snapshots"])
+
+    result.update({
+        "notes": f.getvalue(),
+        "pages_skipped": stats["pages_skipped"],
+        "annotation_rows": rows or [],
+        "images_filtered": image_filter.counts,
+        "timings": report.timings,
+        "counts": report.counts,
+        "errors": report.errors,
+    })
+    return result
+
+
+def _submit_ranges(executor, path_to_pdf, ranges, pdf_slug, path_to_notes, write_images, options):
+    futures = [
+        executor.submit(_shard_worker, path_to_pdf, pages, pdf_slug, path_to_notes, write_images, options)
+        for pages in ranges
+    ]
+    return [future.result() for future in futures]
+
+
+def run_shards(path_to_pdf, page_count, workers, pdf_slug, path_to_notes, write_images, image_store, image_threads, image_filter, collect_annotations, memory_guard, delta, word_cache, snapshots, report, executor = None):
+    '''Write the pages of one large PDF on several processes; returns Parts.
+
+    The ranges go to executor (the run's own process pool) when given, so
+    no more than its workers are ever running; otherwise to a new pool.
+
+    An image shared by pages in different ranges is saved by each range
+    that meets it; the merge keeps the first copy, points later references
+    at it and removes the others, as a serial run would have done.
+    '''
+    options = {
+        "image_store": image_store,
+        "image_threads": image_threads,
+        "image_filter": image_filter,
+        "collect_annotations": collect_annotations,
+        "memory_limit_mb": memory_guard.limit_mb,
+        "delta": delta,
+        "word_cache": word_cache,
+        "snapshots": snapshots,
+    }
+    ranges = page_ranges(page_count, workers)
+    if executor is None:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = _submit_ranges(executor, path_to_pdf, ranges, pdf_slug, path_to_notes, write_images, options)
+    else:
+        results = _submit_ranges(executor, path_to_pdf, ranges, pdf_slug, path_to_notes, write_images, options)
+
+    parts = Parts()
+    index_texts, notes_texts = [], []
+    saved_images = {}
+    for result in results:
+        index_text = result["index"] or ""
+        for xref, reference in result["saved"].items():
+            first = saved_images.setdefault(xref, reference)
+            if reference is not None and first is not None and first != reference:
+                index_text = index_text.replace(f"({reference})", f"({first})")
+                try:
+                    os.remove(os.path.join(path_to_notes, reference))
+                except OSError:
+                    pass
+                result["counts"]["images_saved"] -= 1
+        index_texts.append(index_text)
+        notes_texts.append(result["notes"])
+        parts.image_bytes += result["image_bytes"]
+        parts.pages_skipped += result["pages_skipped"]
+        parts.annotation_rows.extend(result["annotation_rows"])
+
+        image_filter.counts.update(result["images_filtered"])
+        for name, seconds in result["timings"].items():
+            report.timings[name] = report.timings.get(name, 0.0) + seconds
+        report.counts.update(result["counts"])
+        report.errors.extend(result["errors"])
+
+    parts.index_text = "".join(index_texts)
+    parts.notes_text = "".join(notes_texts)
+    report.count("shards", len(ranges))
+    return parts
@@ -0,0 +1,82 @@
+import hashlib
+import os
+from math import sqrt
+import fitz
+from images import write_file
+
+SNAPSHOT_FOLDER = "snapshots"
+
+# Ink, Square, Circle, Polygon and PolyLine annotations: marks with no text
+# of their own, so the notes show a picture of them instead
+SNAPSHOT_TYPES = (4, 5, 6, 7, 15)
+
+# Points of page kept around the annotation's rect, so the mark is seen in context
+SNAPSHOT_MARGIN = 8
+
+
+def snapshot_key(page_number, annot, dpi, max_pixels):
+    'Changes when the annotation would look different, or be rendered differently'
+    border = annot.border or {}
+    content = repr((
+        page_number,
+        annot.type[0],
+        tuple(round(v, 1) for v in annot.rect),
+        annot.vertices,
+        annot.colors,
+        border.get('width'),
+        annot.opacity,
+        dpi,
+        max_pixels,
+    ))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+class Snapshots:
+    '''Pictures of ink and shape annotations for the notes.
+
+    Only the annotation's rect (plus SNAPSHOT_MARGIN) is rendered, at dpi,
+    scaled down to about max_pixels. Snapshots are saved in the PDF's
+    notes folder as snapshots/<key>.png, named by snapshot_key, so a mark
+    that hasn't changed since an earlier run is not rendered again.
+    '''
+
+    def __init__(self, path_to_notes, dpi = 150, max_pixels = 1000000):
+        self.path = os.path.join(path_to_notes, SNAPSHOT_FOLDER)
+        self.dpi = dpi
+        self.max_pixels = max_pixels
+
+    def wanted(self, annot):
+        return annot.type[0] in SNAPSHOT_TYPES
+
+    def zoom(self, clip):
+        zoom = self.dpi / 72
+        pixels = clip.width * clip.height * zoom * zoom
+        if self.max_pixels and pixels > self.max_pixels:
+            zoom *= sqrt(self.max_pixels / pixels)
+        return zoom
+
+    def reference(self, page, page_number, annot, report):
+        '''Return the snapshot's path relative to the notes/ subfolder,
+        rendering it first if needed; None if there is nothing to render.
+        '''
+        key = snapshot_key(page_number, annot, self.dpi, self.max_pixels)
+        name = f"{key}.png"
+        path = os.path.join(self.path, name)
+        if os.path.exists(path):
+            report.count("snapshots_cached")
+            return f"../{SNAPSHOT_FOLDER}/{name}"
+
+        margin = SNAPSHOT_MARGIN
+        clip = (annot.rect + (-margin, -margin, margin, margin)) & page.rect
+        if clip.is_empty:
+            return None
+        with report.stage("snapshots"):
+            zoom = self.zoom(clip)
+            pix = page.get_pixmap(matrix = fitz.Matrix(zoom, zoom), clip = clip, alpha = False)
+            data = pix.tobytes("png")
+            pix = None
+            os.makedirs(self.path, exist_ok = True)
+            write_file(path, data)
+        report.count("snapshots_rendered")
+        report.count("bytes_written", len(data))
+        return f"../{SNAPSHOT_FOLDER}/{name}"
@@ -1,7 +1,76 @@
 class UserPreferences:
-    def __init__(self, pdfs_path = None, notes_path = None, earliest_modified_date = None):
+    def __init__(self, pdfs_path = None, notes_path = None, earliest_modified_date = None, workers = 1, incremental = True):
         self.pdfs_path = pdfs_path
         self.notes_path = notes_path
         self.earliest_modified_date = earliest_modified_date
         self.debug = False
-        self.image_size = None
\ No newline at end of file
+        # Image filters, applied before any image is decoded (None = off):
+        # minimum width * height in pixels
+        self.image_size = None
+        # maximum ratio of long side to short side
+        self.image_max_aspect = None
+        # minimum drawn width and height on the page, in points
+        self.image_min_rendered = None
+        # images entirely within this many points of the page edge are left out
+        self.image_margin = None
+        # Number of processes used to work through PDFs; 1 keeps the run serial
+        self.workers = workers
+        # Skip PDFs whose content or annotations match the manifest from the last run
+        self.incremental = incremental
+        # Store each distinct image once and hardlink it into the notes folders
+        self.dedupe_images = True
+        # Hash list file, or reference directory, of images to leave out
+        self.image_exclude = None
+        # Threads used to encode and write images while pages are read
+        self.image_threads = 2
+        # Also keep every annotation in <notes>/pdref.sqlite for full-text search
+        self.annotation_db = False
+        # Per-PDF timings and counts written to <notes>/.pdref-reports: "json", "csv" or None
+        self.report_format = "json"
+        # Run reports kept in <notes>/.pdref-reports, oldest removed first; None keeps them all
+        self.keep_reports = 20
+        # Filename globs of PDFs to run under cProfile, e.g. ["*"] or ["*manual*"]
+        self.profile_pdfs = []
+        # Memory ceiling per process in MB; PDFs too big for it are processed
+        # more slowly but in less memory. None for no limit
+        self.memory_limit_mb = None
+        # How the PDF copy in each notes folder is made: "clone" (copy-on-write
+        # where the filesystem supports it), "hardlink" (shares edits with the
+        # original) or "copy"
+        self.pdf_copy = "clone"
+        # Globs of files to look at and of files/folders to leave out, matched
+        # against names and paths relative to the refs folder. None for all PDFs
+        self.include = None
+        self.exclude = None
+        # How many folders deep to look below the refs folder. None for no limit
+        self.max_depth = None
+        # Start processing PDFs while the refs folder is still being searched
+        self.stream_discovery = False
+        # Write only annotations added, changed or removed since the last notes
+        # file, instead of every annotation in the PDF
+        self.delta_notes = False
+        # PDFs with at least this many pages are split into page ranges and
+        # processed by all workers at once. None to never split
+        self.shard_min_pages = 1000
+        # Size limit in MB of the cache of words extracted from each page, kept
+        # in <notes>/.pdref-cache so highlights can be matched without
+        # extracting text again. 0 or None to turn it off
+        self.word_cache_mb = 200
+        # Threads that read the next PDFs and write the last PDFs' copies and
+        # notes while a serial run extracts the current one. 0 to do every
+        # step of every PDF in turn
+        self.io_threads = 4
+        # Show ink, square, circle and polygon annotations in the notes as
+        # pictures of the area they cover (plus a small margin), rendered at
+        # snapshot_dpi and scaled down to about snapshot_max_pixels pixels
+        self.annotation_snapshots = False
+        self.snapshot_dpi = 150
+        self.snapshot_max_pixels = 1000000
+        # After an interrupted run, skip the PDFs it had already finished (even
+        # when not incremental) and any PDF that was in progress when two runs
+        # in a row stopped
+        self.resume = False
+        # Keep catalog.json, catalog.md and catalog-index.md in the notes folder:
+        # every PDF's title, author, keywords and annotation count, plus indexes
+        # by keyword and author
+        self.catalog = False
\ No newline at end of file
@@ -0,0 +1,105 @@
+import os
+from fnmatch import fnmatchcase
+
+# pdref's own files in a notes folder: the manifest, reports, image store
+# and search database all start with one of these
+OWN_PREFIXES = (".pdref", "pdref.sqlite")
+
+
+class PdfWalker:
+    '''Finds PDFs under root with os.scandir.
+
+    Directories are visited depth first in the same order as os.walk. The
+    stat result of every PDF comes from its DirEntry and is kept in
+    self.stats, keyed by path, so later steps don't stat it again.
+
+    include and exclude are lists of globs matched against a file or
+    directory's name and its path relative to root, with / separators
+    (e.g. "*.pdf", "drafts", "archive/*/old-*"). Excluded directories are
+    not entered. max_depth 0 only looks at root itself.
+
+    The notes folder is never crawled: when it is inside root it is
+    skipped entirely, and when root is the notes folder (or inside it)
+    only pdref's copies (<slug>/<slug>.pdf) and its own files are skipped.
+    '''
+
+    def __init__(self, root, include = None, exclude = None, max_depth = None, notes_path = None):
+        self.root = os.path.abspath(root)
+        self.include = include or ["*.pdf"]
+        self.exclude = exclude or []
+        self.max_depth = max_depth
+        self.notes_path = os.path.abspath(notes_path) if notes_path else None
+        self.stats = {}
+
+    def matches(self, patterns, path, name):
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return any(fnmatchcase(name, p) or fnmatchcase(relative, p) for p in patterns)
+
+    def is_notes(self, directory):
+        return self.notes_path is not None and directory == self.notes_path
+
+    def crawling_notes(self):
+        return self.notes_path is not None and (self.root + os.sep).startswith(self.notes_path + os.sep)
+
+    def is_own(self, directory, name):
+        # Files pdref wrote into the notes folder it is crawling
+        if self.is_notes(directory):
+            return name.startswith(OWN_PREFIXES)
+        if self.notes_path is not None and os.path.dirname(directory) == self.notes_path:
+            return os.path.splitext(name)[0] == os.path.basename(directory)
+        return False
+
+    def accepts(self, path):
+        'Whether walking would find the file at path (e.g. one reported by a watcher)'
+        path = os.path.abspath(path)
+        relative = os.path.relpath(path, self.root)
+        if relative.startswith(os.pardir):
+            return False
+        crawling_notes = self.crawling_notes()
+        parts = relative.split(os.sep)
+        if self.max_depth is not None and len(parts) - 1 > self.max_depth:
+            return False
+        directory = self.root
+        for name in parts:
+            child = os.path.join(directory, name)
+            if crawling_notes and self.is_own(directory, name):
+                return False
+            if self.exclude and self.matches(self.exclude, child, name):
+                return False
+            if self.is_notes(child):
+                return False
+            directory = child
+        return self.matches(self.include, path, parts[-1])
+
+    def __iter__(self):
+        'Yield (path, stat) for every matching file'
+        crawling_notes = self.crawling_notes()
+        stack = [(self.root, 0)]
+        while stack:
+            directory, depth = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as e:
+                print(f"Could not read {directory}: {e}")
+                continue
+            subdirectories = []
+            with entries:
+                for entry in entries:
+                    if crawling_notes and self.is_own(directory, entry.name):
+                        continue
+                    if self.exclude and self.matches(self.exclude, entry.path, entry.name):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            # Like os.walk, symlinked directories aren't followed
+                            if entry.is_symlink() or self.is_notes(entry.path):
+                                continue
+                            if self.max_depth is None or depth < self.max_depth:
+                                subdirectories.append(entry.path)
+                        elif self.matches(self.include, entry.path, entry.name):
+                            stat = entry.stat()
+                            self.stats[entry.path] = stat
+                            yield entry.path, stat
+                    except OSError:
+                        continue
+            stack.extend((path, depth + 1) for path in reversed(subdirectories))
@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from crawl import crawl, pdf_slug, process_pdfs
+from walk import PdfWalker
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_pdf(path):
+    return os.path.splitext(path)[-1] == '.pdf'
+
+
+def is_excluded(path, excluded):
+    path = os.path.abspath(path)
+    return any(path == e or path.startswith(e + os.sep) for e in excluded)
+
+
+def scan_pdfs(walker):
+    'Return {path: (size, mtime)} for every PDF walker (a PdfWalker) finds'
+    return {path: (stat.st_size, stat.st_mtime) for path, stat in walker}
+
+
+class InotifyWatcher:
+    '''Reports PDFs written or moved into a directory tree, using Linux inotify.
+
+    Every directory in the tree gets a watch; directories created or moved
+    in later are added as they appear. walker (a PdfWalker) is used to
+    rescan the tree if events are lost.
+    '''
+
+    def __init__(self, root, excluded = (), walker = None):
+        self.excluded = excluded
+        self.walker = walker if walker is not None else PdfWalker(root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.add_tree(root)
+        self.root = root
+
+    def add_tree(self, root):
+        'Watch root and its subdirectories; returns the PDFs already in them'
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not is_excluded(os.path.join(dirpath, d), self.excluded)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = dirpath
+            found.update(os.path.abspath(os.path.join(dirpath, f)) for f in filenames if is_pdf(f))
+        return found
+
+    def read(self, timeout):
+        'Wait up to timeout seconds and return the set of changed PDF paths'
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; fall back to looking at everything
+                changed.update(scan_pdfs(self.walker))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if not is_excluded(path, self.excluded):
+                    changed.update(self.add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_pdf(name):
+                changed.add(os.path.abspath(path))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    '''Reports new or modified PDFs by rescanning the tree with walker (a
+    PdfWalker) every interval seconds.'''
+
+    def __init__(self, walker, interval = 5.0):
+        self.walker = walker
+        self.interval = interval
+        self.snapshot = scan_pdfs(walker)
+        self.next_scan = time.monotonic() + interval
+
+    def read(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+
+        snapshot = scan_pdfs(self.walker)
+        changed = {path for path, stat in snapshot.items() if self.snapshot.get(path) != stat}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(walker, excluded = (), poll_interval = 5.0, polling = False):
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(walker.root, excluded, walker)
+        except (OSError, AttributeError) as e:
+            print(f"inotify is not available ({e}); checking for changes every {poll_interval}s instead")
+    return PollingWatcher(walker, poll_interval)
+
+
+def watch(preferences, debounce = 2.0, poll_interval = 5.0, polling = False, stop = None):
+    '''Run crawl once, then keep processing PDFs as they are added or modified.
+
+    Changes are collected until none have arrived for debounce seconds, so
+    a PDF being saved repeatedly, or a folder being copied in, is processed
+    once. stop is an optional threading.Event that ends the loop.
+    '''
+    crawl(preferences)
+    if not os.path.exists(preferences.pdfs_path):
+        return
+
+    # Never react to our own writes when the notes folder is inside the refs folder
+    excluded = (os.path.abspath(preferences.notes_path),)
+    walker = PdfWalker(preferences.pdfs_path, preferences.include, preferences.exclude, preferences.max_depth, preferences.notes_path)
+    watcher = make_watcher(walker, excluded, poll_interval, polling)
+    print(f"Watching {preferences.pdfs_path} for changes")
+
+    pending = set()
+    last_change = 0.0
+    try:
+        while stop is None or not stop.is_set():
+            changed = watcher.read(min(debounce, 1.0) if pending else 1.0)
+            if changed:
+                pending.update(changed)
+                last_change = time.monotonic()
+                continue
+            if pending and time.monotonic() - last_change >= debounce:
+                batch = sorted(path for path in pending if os.path.exists(path) and walker.accepts(path))
+                pending = set()
+                process_pdfs([(path, pdf_slug(path)) for path in batch], preferences)
+    finally:
+        watcher.close()
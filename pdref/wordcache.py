@@ -0,0 +1,162 @@
+import hashlib
+import os
+import re
+import fitz
+
+CACHE_NAME = os.path.join(".pdref-cache", "words")
+
+# Trimming stops once the cache is this fraction of its limit, so it isn't
+# trimmed again after every run
+TRIM_TO = 0.9
+
+
+# Bumped whenever page_key changes, so entries made under an older key
+# are never looked up again
+KEY_VERSION = 3
+
+REFERENCE = re.compile(rb"(\d+) \d+ R")
+
+
+def page_resources(doc, xref):
+    'The /Resources of a page object, following /Parent when they are inherited'
+    while xref:
+        kind, value = doc.xref_get_key(xref, "Resources")
+        if kind == "xref":
+            return doc.xref_object(int(value.split()[0]), compressed = True)
+        if kind == "dict":
+            return value
+        kind, value = doc.xref_get_key(xref, "Parent")
+        xref = int(value.split()[0]) if kind == "xref" else 0
+    return ""
+
+
+def object_digest(doc, xref, digests):
+    '''Return (digest, referenced xrefs) for one object: its definition
+    and, unless it is an image, its raw stream. digests is the memo for
+    doc, so fonts and forms shared by many pages are hashed once.
+    '''
+    found = digests.get(xref)
+    if found is None:
+        definition = doc.xref_object(xref, compressed = True).encode('utf-8')
+        h = hashlib.sha1(b"%d " % xref)
+        h.update(definition)
+        if doc.xref_is_stream(xref) and doc.xref_get_key(xref, "Subtype") != ("name", "/Image"):
+            h.update(doc.xref_stream_raw(xref) or b"")
+        found = (h.digest(), [int(n) for n in REFERENCE.findall(definition)])
+        digests[xref] = found
+    return found
+
+
+def page_key(page, digests = None):
+    '''Identifies a page's text layer: its content streams, size, rotation
+    and everything its /Resources refer to (fonts, Form XObjects and what
+    they use in turn), so two pages that draw the same form with different
+    contents get different keys.
+
+    Annotations live outside these, so adding or editing one (which changes
+    the file's hash) keeps the key; editing the page's text changes it.
+    Image data is left out, as it doesn't change the words extracted. The
+    PyMuPDF version is included in case extraction changes. digests is an
+    optional {xref: object_digest} memo for page's document.
+    '''
+    doc = page.parent
+    if digests is None:
+        digests = {}
+    h = hashlib.sha1(repr((KEY_VERSION, fitz.VersionBind, tuple(page.rect), page.rotation)).encode('utf-8'))
+    for xref in page.get_contents():
+        h.update(doc.xref_stream_raw(xref) or b"")
+
+    resources = page_resources(doc, page.xref)
+    h.update(resources.encode('utf-8'))
+    seen = set()
+    pending = [int(n) for n in REFERENCE.findall(resources.encode('utf-8'))]
+    while pending:
+        xref = pending.pop()
+        if xref in seen or not 0 < xref < doc.xref_length():
+            continue
+        seen.add(xref)
+        digest, references = object_digest(doc, xref, digests)
+        h.update(digest)
+        pending.extend(references)
+    return h.hexdigest()
+
+
+class WordCache:
+    '''Words extracted from PDF pages, kept on disk between runs.
+
+    Lives in <notes>/.pdref-cache/words, one file per page (see
+    parse.WordTable.to_bytes for the format), named by page_key. Reading
+    an entry updates its mtime; trim() removes the least recently used
+    entries once the cache is over max_mb.
+    '''
+
+    def __init__(self, notes_path, max_mb = 200):
+        self.path = os.path.join(notes_path, CACHE_NAME)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.document = None
+        self.object_digests = {}
+
+    def __getstate__(self):
+        # The memo belongs to a document open in this process
+        return dict(self.__dict__, document = None, object_digests = {})
+
+    def digests(self, doc):
+        'The page_key memo for doc, kept while pages of the same document are looked up'
+        if self.document is not doc:
+            self.document = doc
+            self.object_digests = {}
+        return self.object_digests
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.words")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # A full disk or read-only notes folder only costs the cache
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def trim(self):
+        'Remove the least recently used entries over the size limit; returns how many'
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes * TRIM_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
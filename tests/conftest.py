@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The pdref modules import each other as top-level modules, as when run from pdref/
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "pdref"))
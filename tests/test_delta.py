@@ -0,0 +1,89 @@
+"""AnnotationRecord.delta(): which annotations a delta notes file lists
+after annotations are added, edited and removed between runs.
+"""
+import fitz
+from annotationdb import annotation_id
+from delta import AnnotationRecord
+from parse import annotation_digest
+
+SLUG = "doc"
+
+
+def make_doc():
+    # PyMuPDF names new annotations (/NM), so their ids don't depend on position
+    doc = fitz.open()
+    for _ in range(3):
+        doc.new_page()
+    # Adding a page lets go of the Page objects loaded before it
+    pages = [doc[i] for i in range(3)]
+    pages[0].add_text_annot((50, 50), "first comment")
+    pages[1].add_highlight_annot(fitz.Rect(72, 72, 200, 90))
+    pages[2].add_text_annot((80, 80), "to be removed")
+    return doc
+
+
+def record_of(doc, path_to_notes):
+    record = AnnotationRecord(path_to_notes)
+    annotation_digest(doc, SLUG, record)
+    return record
+
+
+def ids(doc, page_number):
+    return [annotation_id(SLUG, page_number, annot) for annot in doc[page_number - 1].annots()]
+
+
+def test_no_earlier_record(tmp_path):
+    record = record_of(make_doc(), str(tmp_path))
+    assert record.previous is None
+    assert record.delta() is None
+
+
+def test_nothing_changed(tmp_path):
+    doc = make_doc()
+    record_of(doc, str(tmp_path)).save()
+    assert record_of(doc, str(tmp_path)).delta() == ({}, [])
+
+
+def test_added_changed_and_removed(tmp_path):
+    doc = make_doc()
+    record_of(doc, str(tmp_path)).save()
+    first, = ids(doc, 1)
+    highlight, = ids(doc, 2)
+    removed, = ids(doc, 3)
+
+    # Edit the comment, add a highlight and delete the page 3 note
+    page = doc[0]
+    annot = page.first_annot
+    annot.set_info(content="first comment, edited")
+    annot.update()
+    doc[1].add_highlight_annot(fitz.Rect(72, 120, 200, 138))
+    page = doc[2]
+    page.delete_annot(page.first_annot)
+    added = [id for id in ids(doc, 2) if id != highlight]
+
+    changed, gone = record_of(doc, str(tmp_path)).delta()
+    assert changed == {first: "changed", added[0]: "added"}
+    assert gone == [(removed, 3, "to be removed")]
+
+
+def test_moved_annotation_is_changed(tmp_path):
+    doc = make_doc()
+    record_of(doc, str(tmp_path)).save()
+    first, = ids(doc, 1)
+    page = doc[0]
+    annot = page.first_annot
+    annot.set_rect(fitz.Rect(300, 300, 320, 320))
+    annot.update()
+    # The id comes from the annotation's /NM, so it survives the move
+    assert ids(doc, 1) == [first]
+    assert record_of(doc, str(tmp_path)).delta() == ({first: "changed"}, [])
+
+
+def test_save_keeps_only_current(tmp_path):
+    doc = make_doc()
+    record_of(doc, str(tmp_path)).save()
+    page = doc[2]
+    page.delete_annot(page.first_annot)
+    record_of(doc, str(tmp_path)).save()
+    # Removed once, not listed again on the next run
+    assert record_of(doc, str(tmp_path)).delta() == ({}, [])
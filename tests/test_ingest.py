@@ -0,0 +1,92 @@
+"""DuplicateFinder: slug collisions and duplicate content, against the
+manifest and against PDFs found earlier in the same run.
+"""
+import os
+import ingest
+from ingest import DuplicateFinder
+from manifest import Manifest, file_hash
+
+
+def make_pdf(folder, name, content):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def check(finder, path, slug):
+    return finder.check(path, slug, os.path.getsize(path))
+
+
+def manifest_with(tmp_path, *paths_and_slugs):
+    manifest = Manifest(str(tmp_path / "notes"))
+    for path, slug in paths_and_slugs:
+        manifest.update(path, {"size": os.path.getsize(path), "slug": slug, "hash": file_hash(path)})
+    return manifest
+
+
+def test_slug_collision_in_one_run(tmp_path):
+    a = make_pdf(tmp_path, "My Paper.pdf", b"%PDF one")
+    b = make_pdf(tmp_path, "my_paper.pdf", b"%PDF two, longer")
+    finder = DuplicateFinder(manifest_with(tmp_path))
+    assert check(finder, a, "my-paper") is None
+    assert check(finder, b, "my-paper") == ("slug collision", a)
+
+
+def test_slug_collision_with_manifest(tmp_path):
+    a = make_pdf(tmp_path, "a.pdf", b"%PDF one")
+    b = make_pdf(tmp_path, "b.pdf", b"%PDF two, longer")
+    finder = DuplicateFinder(manifest_with(tmp_path, (a, "paper")))
+    # The same PDF again is not a collision with itself
+    assert check(finder, a, "paper") is None
+    assert check(finder, b, "paper") == ("slug collision", a)
+
+
+def test_slug_of_deleted_pdf_is_free(tmp_path):
+    a = make_pdf(tmp_path, "a.pdf", b"%PDF one")
+    b = make_pdf(tmp_path, "b.pdf", b"%PDF two")
+    manifest = manifest_with(tmp_path, (a, "paper"))
+    os.remove(a)
+    assert check(DuplicateFinder(manifest), b, "paper") is None
+
+
+def test_duplicate_in_one_run(tmp_path):
+    a = make_pdf(tmp_path, "a.pdf", b"%PDF same content")
+    b = make_pdf(tmp_path, "b.pdf", b"%PDF same content")
+    finder = DuplicateFinder(manifest_with(tmp_path))
+    assert check(finder, a, "a") is None
+    assert check(finder, b, "b") == ("duplicate", a)
+
+
+def test_duplicate_of_manifest_entry(tmp_path):
+    a = make_pdf(tmp_path, "a.pdf", b"%PDF same content")
+    b = make_pdf(tmp_path, "b.pdf", b"%PDF same content")
+    finder = DuplicateFinder(manifest_with(tmp_path, (a, "a")))
+    assert check(finder, b, "b") == ("duplicate", a)
+
+
+def test_same_size_different_content(tmp_path):
+    a = make_pdf(tmp_path, "a.pdf", b"%PDF content A")
+    b = make_pdf(tmp_path, "b.pdf", b"%PDF content B")
+    finder = DuplicateFinder(manifest_with(tmp_path))
+    assert check(finder, a, "a") is None
+    assert check(finder, b, "b") is None
+
+
+def test_only_same_size_files_are_hashed(tmp_path, monkeypatch):
+    hashed = []
+
+    def counting_hash(path):
+        hashed.append(os.path.basename(path))
+        return file_hash(path)
+
+    monkeypatch.setattr(ingest, "file_hash", counting_hash)
+    paths = [make_pdf(tmp_path, f"{n}.pdf", b"%PDF" + b"x" * n) for n in range(5)]
+    finder = DuplicateFinder(manifest_with(tmp_path))
+    for n, path in enumerate(paths):
+        assert check(finder, path, str(n)) is None
+    assert hashed == []
+
+    same = make_pdf(tmp_path, "same.pdf", b"%PDF" + b"y" * 3)
+    assert check(finder, same, "same") is None
+    assert sorted(hashed) == ["3.pdf", "same.pdf"]
@@ -0,0 +1,144 @@
+"""Journal: what an interrupted run leaves behind and what a resumed run
+does with it (restored entries, skipped PDFs, MAX_ATTEMPTS).
+"""
+import os
+from journal import JOURNAL_NAME, MAX_ATTEMPTS, Journal
+from manifest import Manifest
+
+
+def make_pdf(folder, name, content=b"%PDF-1.4 test"):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def entry_for(path, slug):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "slug": slug, "hash": "h-" + slug}
+
+
+def interrupted_run(notes, finished=(), in_progress=(), resume=False):
+    # A run that finished some PDFs and was killed while working on others
+    journal = Journal(notes)
+    journal.open(resume)
+    for path, slug in finished:
+        journal.started(path, slug)
+        journal.done(path, True, entry_for(path, slug))
+    for path, slug in in_progress:
+        journal.started(path, slug)
+    journal.close(complete=False)
+
+
+def test_complete_run_removes_journal(tmp_path):
+    notes = str(tmp_path)
+    pdf = make_pdf(notes, "a.pdf")
+    journal = Journal(notes)
+    assert not journal.interrupted
+    journal.open()
+    journal.started(pdf, "a")
+    journal.done(pdf, True, entry_for(pdf, "a"))
+    journal.close(complete=True)
+    assert not os.path.exists(os.path.join(notes, JOURNAL_NAME))
+    assert not Journal(notes).interrupted
+
+
+def test_interrupted_run_is_restored(tmp_path):
+    notes = str(tmp_path)
+    a, b = make_pdf(notes, "a.pdf"), make_pdf(notes, "b.pdf")
+    interrupted_run(notes, finished=[(a, "a")], in_progress=[(b, "b")])
+
+    journal = Journal(notes)
+    assert journal.interrupted
+    assert journal.finished == {a: entry_for(a, "a")}
+    assert journal.attempts == {b: 1}
+
+    manifest = Manifest(notes)
+    journal.restore(manifest)
+    assert manifest.get(a) == entry_for(a, "a")
+    assert manifest.get(b) is None
+
+
+def test_resume_skips_finished_and_failed(tmp_path):
+    notes = str(tmp_path)
+    a, b, c = make_pdf(notes, "a.pdf"), make_pdf(notes, "b.pdf"), make_pdf(notes, "c.pdf")
+    journal = Journal(notes)
+    journal.open()
+    journal.started(a, "a")
+    journal.done(a, True, entry_for(a, "a"))
+    journal.started(c, "c")
+    journal.done(c, False, None)
+    journal.started(b, "b")
+    journal.close(complete=False)
+
+    skipped = []
+    left = list(Journal(notes).skip_done([(a, "a"), (b, "b"), (c, "c")], skipped))
+    assert left == [(b, "b")]
+    assert skipped == []
+
+
+def test_resume_processes_pdfs_modified_since(tmp_path):
+    notes = str(tmp_path)
+    a = make_pdf(notes, "a.pdf")
+    interrupted_run(notes, finished=[(a, "a")])
+    make_pdf(notes, "a.pdf", b"%PDF-1.4 edited since the run stopped")
+
+    skipped = []
+    assert list(Journal(notes).skip_done([(a, "a")], skipped)) == [(a, "a")]
+
+
+def test_max_attempts(tmp_path):
+    notes = str(tmp_path)
+    a, b = make_pdf(notes, "a.pdf"), make_pdf(notes, "b.pdf")
+    for run in range(MAX_ATTEMPTS):
+        journal = Journal(notes)
+        left = list(journal.skip_done([(a, "a"), (b, "b")], []))
+        assert left == [(a, "a"), (b, "b")]
+        # Each resumed run adds to the journal and stops on b again
+        interrupted_run(notes, in_progress=[(b, "b")], resume=run > 0)
+
+    journal = Journal(notes)
+    assert journal.attempts[b] == MAX_ATTEMPTS
+    skipped = []
+    assert list(journal.skip_done([(a, "a"), (b, "b")], skipped)) == [(a, "a")]
+    assert skipped == [(b, "b", MAX_ATTEMPTS)]
+
+
+def test_new_run_starts_a_new_journal(tmp_path):
+    notes = str(tmp_path)
+    b = make_pdf(notes, "b.pdf")
+    interrupted_run(notes, in_progress=[(b, "b")])
+    # Not resuming: the attempts of the earlier run are not carried over
+    interrupted_run(notes, in_progress=[(b, "b")], resume=False)
+    assert Journal(notes).attempts[b] == 1
+
+
+def test_cancelled_pdfs_dont_count_as_attempts(tmp_path):
+    notes = str(tmp_path)
+    b = make_pdf(notes, "b.pdf")
+    journal = Journal(notes)
+    journal.open()
+    journal.started(b, "b")
+    journal.cancelled(b)
+    journal.close(complete=False)
+    assert Journal(notes).attempts[b] == 0
+
+
+def test_cut_short_line_and_stale_tmp(tmp_path):
+    notes = str(tmp_path)
+    a, b = make_pdf(notes, "a.pdf"), make_pdf(notes, "b.pdf")
+    os.makedirs(os.path.join(notes, "b", "notes"))
+    stale = [os.path.join(notes, "b", "_index.md.123-456.tmp"), os.path.join(notes, "b", "notes", "x.md.tmp")]
+    for path in stale:
+        make_pdf(os.path.dirname(path), os.path.basename(path))
+    kept = make_pdf(os.path.join(notes, "b"), "_index.md")
+    interrupted_run(notes, finished=[(a, "a")], in_progress=[(b, "b")])
+    # A killed run may leave half a line
+    with open(os.path.join(notes, JOURNAL_NAME), "a", encoding='utf-8') as f:
+        f.write('{"event":"finished","pdf":')
+
+    journal = Journal(notes)
+    assert set(journal.finished) == {a}
+    assert journal.attempts == {b: 1}
+    assert not any(os.path.exists(path) for path in stale)
+    assert os.path.exists(kept)
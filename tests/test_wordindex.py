@@ -0,0 +1,135 @@
+"""WordIndex and WordTable must quote the same text as the brute-force
+matching they replaced (a fitz.Rect intersects() scan over every word,
+then make_text as it was before the table existed).
+"""
+import random
+import fitz
+import pytest
+from parse import WordIndex, WordTable
+
+
+def old_make_text(words):
+    # make_text before WordTable, kept as the reference
+    line_dict = {}
+    words.sort(key=lambda w: w[0])
+    for w in words:
+        y1 = round(w[3], 1)
+        line = line_dict.get(y1, [])
+        line.append(w[4])
+        line_dict[y1] = line
+    lines = list(line_dict.items())
+    lines.sort()
+    return " ".join([" ".join(line[1]) for line in lines])
+
+
+def brute_force(words, rect):
+    return old_make_text([w for w in words if fitz.Rect(w[:4]).intersects(rect)])
+
+
+def indexed(words, rect):
+    index = WordIndex(WordTable(words))
+    return index.table.make_text(index.intersecting(rect))
+
+
+def random_words(rng, count):
+    words = []
+    for n in range(count):
+        x0 = rng.uniform(0, 560)
+        y0 = rng.uniform(0, 800)
+        words.append((x0, y0, x0 + rng.uniform(5, 60), y0 + rng.uniform(8, 14), f"w{n}", 0, 0, n))
+    return words
+
+
+def line_words():
+    # Lines of words whose bottoms round to the same 0.1, some sharing x0
+    words = []
+    n = 0
+    for line in range(20):
+        y1 = 100 + line * 14.0
+        for column in range(10):
+            x0 = 72 + column * 40.0
+            words.append((x0, y1 - 10, x0 + 35, y1 + random.Random(n).uniform(-0.04, 0.04), f"l{line}c{column}", 0, 0, n))
+            n += 1
+        # A second word starting at the same x0 as the first on the line
+        words.append((72.0, y1 - 10, 90.0, y1, f"l{line}tie", 0, 0, n))
+        n += 1
+    return words
+
+
+def random_rect(rng):
+    x0, y0 = rng.uniform(-100, 650), rng.uniform(-100, 900)
+    return fitz.Rect(x0, y0, x0 + rng.uniform(0, 300), y0 + rng.uniform(0, 80))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_rects(seed):
+    rng = random.Random(seed)
+    words = random_words(rng, 400)
+    index = WordIndex(WordTable(words))
+    for _ in range(200):
+        rect = random_rect(rng)
+        assert index.table.make_text(index.intersecting(rect)) == brute_force(words, rect)
+
+
+def test_tied_lines():
+    words = line_words()
+    rng = random.Random(1)
+    for _ in range(200):
+        rect = random_rect(rng)
+        assert indexed(words, rect) == brute_force(words, rect)
+    # The whole page: every line, ties in input order
+    assert indexed(words, fitz.Rect(0, 0, 612, 792)) == brute_force(words, fitz.Rect(0, 0, 612, 792))
+
+
+def test_empty_boxes():
+    words = [
+        (100, 100, 100, 112, "zero-width", 0, 0, 0),
+        (120, 100, 160, 100, "zero-height", 0, 0, 1),
+        (170, 100, 210, 112, "word", 0, 0, 2),
+    ]
+    for rect in (fitz.Rect(90, 95, 220, 115), fitz.Rect(100, 100, 100, 112), fitz.Rect(150, 105, 150, 105)):
+        assert indexed(words, rect) == brute_force(words, rect)
+
+
+def test_rects_off_the_page():
+    words = random_words(random.Random(2), 100)
+    for rect in (fitz.Rect(-200, -200, -10, -10), fitz.Rect(700, 900, 900, 1000), fitz.Rect(-50, 100, 5, 300), fitz.Rect(0, -1000, 612, -500)):
+        assert indexed(words, rect) == brute_force(words, rect)
+
+
+def test_no_words():
+    assert indexed([], fitz.Rect(0, 0, 100, 100)) == brute_force([], fitz.Rect(0, 0, 100, 100)) == ""
+
+
+def test_real_page():
+    doc = fitz.open()
+    page = doc.new_page()
+    for line in range(30):
+        page.insert_text((72, 80 + line * 20), f"line {line} of some quoted text, with words", fontsize=11)
+    words = page.get_text_words()
+    rng = random.Random(3)
+    for _ in range(100):
+        rect = random_rect(rng)
+        assert indexed(words, rect) == brute_force(words, rect)
+
+
+def test_bytes_round_trip():
+    words = random_words(random.Random(4), 50) + [(1.5, 2.25, 3.125, 4.0, "naïve – ünïcode ✓", 0, 0, 0), (0, 0, 0, 0, "", 0, 0, 0)]
+    table = WordTable(words)
+    copy = WordTable.from_bytes(table.to_bytes())
+    assert copy is not None
+    assert [copy[i] for i in range(len(copy))] == [table[i] for i in range(len(table))]
+    assert copy.make_text() == table.make_text()
+
+
+def test_bytes_round_trip_empty():
+    copy = WordTable.from_bytes(WordTable().to_bytes())
+    assert copy is not None and len(copy) == 0
+
+
+def test_bad_bytes_rejected():
+    data = WordTable(random_words(random.Random(5), 10)).to_bytes()
+    assert WordTable.from_bytes(b"") is None
+    assert WordTable.from_bytes(b"XXXX" + data[4:]) is None
+    assert WordTable.from_bytes(data[:-1]) is None
+    assert WordTable.from_bytes(data + b"x") is None